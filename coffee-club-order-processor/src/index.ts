@@ -1,10 +1,10 @@
 import { getFullnodeUrl, SuiClient } from "@mysten/sui/client";
 import { Ed25519Keypair } from "@mysten/sui/keypairs/ed25519";
 import { Transaction } from "@mysten/sui/transactions";
-import { exec } from "child_process";
 import * as dotenv from "dotenv";
+import * as net from "net";
 import * as path from "path";
-import { promisify } from "util";
+import * as readline from "readline";
 import { getAllOrders } from "./getAllOrders";
 
 dotenv.config({ path: path.resolve(__dirname, "../.env") });
@@ -20,13 +20,13 @@ const FULLNODE_URL = process.env.FULLNODE_URL || getFullnodeUrl(NETWORK);
 // Setup your Sui client
 const client = new SuiClient({ url: FULLNODE_URL });
 
-const execAsync = promisify(exec);
 const CAFE_MODULE = "suihub_cafe";
-const CHECK_INTERVAL_MS = 10_000;
-const CONTROLLER_PATH = path.join(
-  __dirname,
-  "../../delonghi_controller/src/delonghi_controller.py"
-);
+const CHECK_INTERVAL_MS = 2_000;
+// Order intake of `delonghi_controller.py serve`
+const CONTROLLER_INTAKE = process.env.CONTROLLER_INTAKE || "127.0.0.1:8765";
+const INTAKE_RETRY_MS = 5_000;
+// Delay before pushing again an order whose start command was not sent
+const ORDER_RETRY_MS = 10_000;
 const MAC_ADDRESS = process.env.MAC_ADDRESS;
 
 if (!ADMIN_PHRASE) {
@@ -39,14 +39,6 @@ if (!CAFE_ID) {
   throw new Error("CAFE_ID environment variable is not set.");
 }
 
-const COFFEE_TYPE_DELAYS: { [key: string]: number } = {
-  espresso: 90_000, // 90 seconds
-  coffee: 90_000, // 90 seconds
-  americano: 120_000, // 120 seconds
-  long: 180_000, // 180 seconds
-  default: 60_000, // fallback default
-};
-
 const keypair = Ed25519Keypair.deriveKeypair(ADMIN_PHRASE);
 
 const delay = (ms: number) => new Promise((res) => setTimeout(res, ms));
@@ -134,6 +126,142 @@ const deleteCompletedOrder = async (orderId: string) => {
   }
 };
 
+interface IntakeEvent {
+  order_id: string | null;
+  event: "queued" | "brewing" | "done" | "failed";
+  mac?: string;
+  confirmed?: boolean;
+  state?: string | null;
+  error?: string;
+}
+
+// A failure without a state, or journaled "failed", never reached the machine,
+// e.g. it was not found; pushing the order again cannot brew a second cup
+const isRetryable = (message: IntakeEvent) =>
+  !message.state || message.state === "failed";
+
+// Orders pushed to the controller which are not done or failed yet, with
+// their coffee type so they can be pushed again after a lost connection
+const ordersInFlight = new Map<string, string | undefined>();
+// Orders the controller rejected, or whose cup may or may not exist
+// (cancelled, interrupted, unconfirmed); left in "Processing" for an operator
+// and forgotten once they leave it
+const ordersFailed = new Set<string>();
+let intake: net.Socket | null = null;
+let reconnecting = false;
+
+const handleIntakeEvent = async (message: IntakeEvent) => {
+  const orderId = message.order_id;
+  switch (message.event) {
+    case "queued":
+    case "brewing":
+      console.log(`Order ${orderId} ${message.event}`);
+      break;
+
+    case "done":
+      ordersInFlight.delete(orderId!);
+      if (!message.confirmed) {
+        // Never complete on chain a cup nobody saw the machine finish
+        console.warn(
+          `Order ${orderId} was not reported finished by the machine, not completing it`
+        );
+        ordersFailed.add(orderId!);
+        break;
+      }
+      await completeOrder(orderId!);
+      break;
+
+    case "failed":
+      console.error(
+        `Order ${orderId} failed: ${message.error}` +
+          (message.state ? ` (${message.state})` : "")
+      );
+      if (!orderId) {
+        break;
+      }
+      if (isRetryable(message) && ordersInFlight.has(orderId)) {
+        // Still in flight while waiting, so polls do not push it meanwhile
+        console.log(
+          `Pushing order ${orderId} again in ${ORDER_RETRY_MS / 1000} seconds`
+        );
+        setTimeout(() => {
+          if (ordersInFlight.has(orderId)) {
+            pushOrder(orderId, ordersInFlight.get(orderId));
+          }
+        }, ORDER_RETRY_MS);
+        break;
+      }
+      ordersFailed.add(orderId);
+      ordersInFlight.delete(orderId);
+      break;
+  }
+};
+
+const sendOrder = (socket: net.Socket, orderId: string) => {
+  socket.write(
+    JSON.stringify({
+      order_id: orderId,
+      beverage: ordersInFlight.get(orderId),
+      mac: MAC_ADDRESS || undefined,
+    }) + "\n"
+  );
+};
+
+const connectIntake = () => {
+  const separator = CONTROLLER_INTAKE.lastIndexOf(":");
+  const socket = net.createConnection({
+    host: CONTROLLER_INTAKE.slice(0, separator),
+    port: Number(CONTROLLER_INTAKE.slice(separator + 1)),
+  });
+  socket.on("connect", () => {
+    // (Re)send every order in flight; the controller follows an order ID it
+    // already has instead of brewing it twice
+    for (const orderId of ordersInFlight.keys()) {
+      sendOrder(socket, orderId);
+    }
+  });
+  readline.createInterface({ input: socket }).on("line", (line) => {
+    let message: IntakeEvent;
+    try {
+      message = JSON.parse(line);
+    } catch (err) {
+      console.error(`Ignoring malformed controller event: ${line}`, err);
+      return;
+    }
+    handleIntakeEvent(message).catch((err) =>
+      console.error("Failed to handle controller event:", err)
+    );
+  });
+  socket.on("error", (err) =>
+    console.error("Controller intake connection error:", err.message)
+  );
+  socket.on("close", () => {
+    intake = null;
+    // Whether orders in flight were brewed is unknown; keep them, and
+    // reconnect to push them again rather than complete them blindly
+    if (ordersInFlight.size > 0 && !reconnecting) {
+      reconnecting = true;
+      setTimeout(() => {
+        reconnecting = false;
+        if (!intake && ordersInFlight.size > 0) {
+          intake = connectIntake();
+        }
+      }, INTAKE_RETRY_MS);
+    }
+  });
+  return socket;
+};
+
+const pushOrder = (orderId: string, coffeeType: string | undefined) => {
+  ordersInFlight.set(orderId, coffeeType);
+  if (!intake) {
+    // Sends every order in flight, this one included, once connected
+    intake = connectIntake();
+  } else if (!intake.connecting) {
+    sendOrder(intake, orderId);
+  }
+};
+
 const pollAndProcessOrders = async () => {
   while (true) {
     const { orders, error } = await getAllOrders();
@@ -144,8 +272,22 @@ const pollAndProcessOrders = async () => {
       continue;
     }
 
+    // Keep failures only for orders still waiting on an operator
+    const processing = new Set(
+      orders
+        .filter((order) => order.status === "Processing")
+        .map((order) => order.orderId)
+    );
+    for (const orderId of ordersFailed) {
+      if (!processing.has(orderId)) {
+        ordersFailed.delete(orderId);
+      }
+    }
+
     if (orders.length === 0) {
-      console.log("No orders found. Retrying in 10 seconds...");
+      console.log(
+        `No orders found. Retrying in ${CHECK_INTERVAL_MS / 1000} seconds...`
+      );
       await delay(CHECK_INTERVAL_MS);
       continue;
     }
@@ -163,31 +305,35 @@ const pollAndProcessOrders = async () => {
 
       switch (order.status) {
         case "Created":
-          console.log(`Processing and completing order ${order.orderId}...`);
+          if (ordersInFlight.has(order.orderId)) break;
+          console.log(`Processing order ${order.orderId}...`);
           if (await processOrder(order.orderId)) {
-            const coffeeType = order.coffeeType?.toLowerCase().trim();
-            console.log("Sending Python Command");
-            console.log(
-              `python3 ${CONTROLLER_PATH} ${MAC_ADDRESS} ${coffeeType}`
-            );
-            const { stdout, stderr } = await execAsync(
-              `python3 ${CONTROLLER_PATH} ${MAC_ADDRESS} ${coffeeType}`
-            );
-            const delayTime =
-              COFFEE_TYPE_DELAYS[coffeeType!] ?? COFFEE_TYPE_DELAYS.default;
-            await delay(delayTime);
-            await completeOrder(order.orderId);
+            // Completed once the controller reports the cup is ready; the
+            // order ID lets the controller drop a retried push
+            pushOrder(order.orderId, order.coffeeType?.toLowerCase().trim());
           }
           break;
 
         case "Processing":
+          if (ordersInFlight.has(order.orderId)) {
+            console.log(`Order ${order.orderId} is being brewed`);
+            break;
+          }
+          if (ordersFailed.has(order.orderId)) {
+            console.warn(
+              `Order ${order.orderId} failed to brew, not completing it`
+            );
+            break;
+          }
+          // Processed but not followed, e.g. after a restart: push it again
+          // and complete it only once the controller reports it done. The
+          // controller's journal keeps it from being brewed twice
           console.log(
-            `Completing order ${
+            `Following order ${
               order.orderId
             }... with coffee type ${order.coffeeType?.toLowerCase()}`
           );
-
-          await completeOrder(order.orderId);
+          pushOrder(order.orderId, order.coffeeType?.toLowerCase().trim());
           break;
 
         case "Completed":
@@ -225,6 +371,7 @@ const pollAndProcessOrders = async () => {
     }
 
     console.log("Finished processing batch. Rechecking for new orders...");
+    await delay(CHECK_INTERVAL_MS);
   }
 };
 
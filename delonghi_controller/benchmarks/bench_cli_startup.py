@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""CLI startup regression benchmark
+
+Times the CLI paths which never talk to a machine (help and argument errors)
+against a bare interpreter, and checks that they do not load bleak, asyncio or
+sqlite3. Exits with a non-zero status when either regresses.
+
+Usage:
+    python -m benchmarks.bench_cli_startup [--runs N] [--budget MILLISECONDS]
+"""
+import argparse
+import compileall
+import statistics
+import subprocess
+import sys
+import time
+
+CASES = {
+    'help': ['help'],
+    'unknown command': ['00:11:22:33:44:55', 'unknown'],
+    'invalid batch': ['00:11:22:33:44:55', 'batch', '/nonexistent/batch.txt'],
+}
+
+
+def _time_cli(args, runs):
+    """Return wall-clock durations of running the CLI with args"""
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-m', 'src.delonghi_controller', *args],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False,
+        )
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _time_interpreter(runs):
+    """Return wall-clock durations of starting a bare interpreter"""
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=False)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+# Module -> a submodule which only appears once it really executed; deferred
+# modules sit in sys.modules unexecuted
+HEAVY_MODULES = {
+    'bleak': 'bleak',
+    'asyncio': 'asyncio.base_events',
+    'sqlite3': '_sqlite3',
+}
+
+
+def _heavy_imports():
+    """Return the heavy modules which running 'help' loads"""
+    result = subprocess.run(
+        [sys.executable, '-c',
+         "import contextlib, io, sys\n"
+         "from src.delonghi_controller import cli\n"
+         "with contextlib.redirect_stdout(io.StringIO()):\n"
+         "    cli(['help'])\n"
+         f"print(' '.join(name for name, marker in {HEAVY_MODULES!r}.items()\n"
+         "               if marker in sys.modules))"],
+        capture_output=True, text=True, check=True,
+    )
+    return result.stdout.split()
+
+
+def main(args: argparse.Namespace):
+    failed = False
+    # Time against compiled modules, as the image ships them
+    compileall.compile_dir('src', quiet=1)
+
+    baseline = statistics.median(_time_interpreter(args.runs))
+    print(f"{'interpreter baseline':<20} median {baseline * 1000:7.1f} ms")
+
+    for name, cli_args in CASES.items():
+        median = statistics.median(_time_cli(cli_args, args.runs))
+        overhead = (median - baseline) * 1000
+        verdict = 'ok' if overhead <= args.budget else 'SLOW'
+        failed |= overhead > args.budget
+        print(f"{name:<20} median {median * 1000:7.1f} ms "
+              f"(+{overhead:.1f} ms) {verdict}")
+
+    heavy = _heavy_imports()
+    if heavy:
+        print(f"help loads {', '.join(heavy)}: FAIL")
+        failed = True
+    else:
+        print(f"help loads {', '.join(HEAVY_MODULES)}: no")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=10,
+        help="Number of runs per case",
+    )
+
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=30,
+        help="Maximum median time per case above a bare interpreter, in milliseconds",
+    )
+
+    main(parser.parse_args())
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""Notification decoder fuzzing and throughput
+
+Feeds random frames, and mutations of the known status frames, through one
+controller's notification decoder and checks its state after every frame:
+no exception, only known statuses, the raw frame kept, and an in-flight
+command cleared exactly when the machine leaves COOKING. Then reports how
+many frames per second the decoder handles. Exits with a non-zero status on
+any crash or invariant violation, or when throughput falls below the floor.
+
+Usage:
+    python -m benchmarks.bench_decoder_fuzz [--frames N] [--seed N]
+        [--logged-frames N] [--min-rate FRAMES_PER_SECOND]
+"""
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+
+from src import delonghi_controller
+from src.delonghi_controller import (
+    COFFEE_GROUNDS_CONTAINER_DETACHED,
+    COFFEE_GROUNDS_CONTAINER_FULL,
+    DEVICE_READY,
+    DEVICE_STATUS,
+    DEVICE_TURNOFF,
+    NOZZLE_STATE,
+    START_COFFEE,
+    WATER_SHORTAGE,
+    WATER_TANK_DETACHED,
+    DelongiPrimadonna,
+)
+
+SEEDS = [
+    bytes(DEVICE_READY), bytes(DEVICE_TURNOFF), bytes(WATER_TANK_DETACHED),
+    bytes(WATER_SHORTAGE), bytes(COFFEE_GROUNDS_CONTAINER_DETACHED),
+    bytes(COFFEE_GROUNDS_CONTAINER_FULL), bytes(START_COFFEE),
+    # Short format seen from newer machines: idle, brewing
+    bytes([0x01, 0xb5, 0x00]), bytes([0x01, 0x9c, 0x00]), bytes([0x01, 0xc3, 0x00]),
+]
+# Bytes which select decoder branches: status and nozzle codes, short format markers
+INTERESTING = [0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x0d, 0x15, 0x7f, 0x80,
+               0x9c, 0xb5, 0xc3, 0xff]
+COOKING = DEVICE_STATUS[3]
+STATUSES = frozenset(DEVICE_STATUS.values())
+NOZZLES = frozenset(NOZZLE_STATE.values())
+MAX_EXAMPLES = 10
+
+
+class _FormattingHandler(logging.Handler):
+    """Formats every record, as a real handler would, and drops it"""
+
+    def emit(self, record):
+        self.format(record)
+
+
+def _mutate(rng, frame):
+    """Return a random mutation of a frame"""
+    frame = bytearray(frame)
+    mutation = rng.randrange(8)
+    if mutation == 0 and frame:  # flip a bit
+        index = rng.randrange(len(frame))
+        frame[index] ^= 1 << rng.randrange(8)
+    elif mutation == 1 and frame:  # put a branch-selecting byte somewhere
+        frame[rng.randrange(len(frame))] = rng.choice(INTERESTING)
+    elif mutation == 2 and frame:  # random byte
+        frame[rng.randrange(len(frame))] = rng.randrange(256)
+    elif mutation == 3:  # truncate
+        del frame[rng.randrange(len(frame) + 1):]
+    elif mutation == 4:  # extend
+        frame.extend(rng.randbytes(rng.randrange(1, 8)))
+    elif mutation == 5:  # insert a byte
+        frame.insert(rng.randrange(len(frame) + 1), rng.randrange(256))
+    elif mutation == 6 and frame:  # delete a byte
+        del frame[rng.randrange(len(frame))]
+    else:  # splice with another known frame
+        other = rng.choice(SEEDS)
+        frame = frame[:rng.randrange(len(frame) + 1)] + other[rng.randrange(len(other) + 1):]
+    return frame
+
+
+def _frames(rng, count):
+    """Yield random frames and stacked mutations of the known frames"""
+    for _ in range(count):
+        if rng.random() < 0.1:
+            yield bytearray(rng.randbytes(rng.randrange(24)))
+            continue
+        frame = rng.choice(SEEDS)
+        for _ in range(rng.randrange(1, 4)):
+            frame = _mutate(rng, frame)
+        yield frame
+
+
+def _violations(machine, frame, previous_status, previous_in_flight, previous_stale):
+    """Return the invariants the machine state breaks after decoding frame"""
+    problems = []
+    if machine.status not in STATUSES:
+        problems.append(f'unknown status {machine.status!r}')
+    if machine.steam_nozzle not in NOZZLES and not (
+            isinstance(machine.steam_nozzle, int) and 0 <= machine.steam_nozzle <= 0xff):
+        problems.append(f'invalid nozzle state {machine.steam_nozzle!r}')
+    if not (isinstance(machine.service, int) and 0 <= machine.service <= 0xff):
+        problems.append(f'invalid service value {machine.service!r}')
+    if not isinstance(machine.switches.is_on, bool):
+        problems.append(f'power state is not a bool: {machine.switches.is_on!r}')
+    if machine.stale:
+        problems.append('state still stale after a frame')
+    if machine._device_status != frame:
+        problems.append('raw status is not the last frame')
+    if len(frame) != 3 and len(frame) <= 5 and machine.status != previous_status:
+        problems.append('status changed by a frame without a status byte')
+    # A stale (restored) COOKING status is left to reconcile()
+    finished = (not previous_stale and previous_status == COOKING
+                and machine.status != COOKING)
+    if previous_in_flight is not None:
+        if finished and machine.in_flight is not None:
+            problems.append('in-flight command kept after leaving COOKING')
+        if not finished and machine.in_flight is not previous_in_flight:
+            problems.append('in-flight command dropped while still COOKING or idle')
+    return problems
+
+
+def fuzz(frames, seed, logged_frames, logger):
+    """
+    Decode frames on one machine, checking invariants after each
+    :param logged_frames: frames decoded with debug logging on, before the
+        logger is set back to warnings for speed
+    :return: (frames decoded, crashes, violations, example failures)
+    """
+    rng = random.Random(seed)
+    logger.setLevel(logging.DEBUG)
+    machine = DelongiPrimadonna('00:11:22:33:44:55')
+    crashes = violations = 0
+    examples = []
+    for count, frame in enumerate(_frames(rng, frames), start=1):
+        if count == logged_frames + 1:
+            logger.setLevel(logging.WARNING)
+        # Now and then start a brew, so sequences exercise its completion
+        if machine.in_flight is None and rng.random() < 0.02:
+            machine.in_flight = {'command': 'beverage_start', 'beverage': 'espresso',
+                                 'order_id': None, 'started_at': 0.0}
+        previous_status = machine.status
+        previous_in_flight = machine.in_flight
+        previous_stale = machine.stale
+        try:
+            machine._on_notification(None, frame)
+            problems = _violations(machine, frame, previous_status, previous_in_flight,
+                                   previous_stale)
+            if count % 64 == 0:
+                json.dumps(machine.as_dict())
+        except Exception as error:
+            crashes += 1
+            problems = [f'{type(error).__name__}: {error}']
+            # Start over from a clean machine, as a reconnect would
+            machine = DelongiPrimadonna(machine.mac)
+        else:
+            violations += bool(problems)
+        if problems and len(examples) < MAX_EXAMPLES:
+            examples.append((bytes(frame).hex(' '), problems))
+    return frames, crashes, violations, examples
+
+
+def throughput(frames, seed):
+    """Return frames per second decoded with logging off"""
+    rng = random.Random(seed)
+    corpus = list(_frames(rng, min(frames, 100_000)))
+    machine = DelongiPrimadonna('00:11:22:33:44:55')
+    decode = machine._on_notification
+    rounds = max(1, frames // len(corpus))
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for frame in corpus:
+            decode(None, frame)
+    return rounds * len(corpus) / (time.perf_counter() - start)
+
+
+def main(args: argparse.Namespace):
+    logger = logging.getLogger(delonghi_controller.__name__)
+    logger.propagate = False
+
+    # Every log record is formatted, so bad logging arguments show up
+    logger.addHandler(_FormattingHandler())
+    frames, crashes, violations, examples = fuzz(
+        args.frames, args.seed, args.logged_frames, logger
+    )
+    print(f"{'frames':<22} {frames:12,}")
+    print(f"{'crashes':<22} {crashes:12,}")
+    print(f"{'invariant violations':<22} {violations:12,}")
+    for frame, problems in examples:
+        print(f"  {frame or '(empty)'}: {'; '.join(problems)}")
+
+    if crashes or violations:
+        print(f"decoder failed on fuzzed frames (seed {args.seed}): FAIL")
+        sys.exit(1)
+
+    rate = throughput(args.frames, args.seed)
+    print(f"{'decode throughput':<22} {rate:12,.0f} frames/s")
+    if rate < args.min_rate:
+        print(f"decoder slower than {args.min_rate:,.0f} frames/s: FAIL")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--frames",
+        type=int,
+        default=1_000_000,
+        help="Number of fuzzed frames",
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed, to reproduce a failure",
+    )
+
+    parser.add_argument(
+        "--logged-frames",
+        type=int,
+        default=50_000,
+        help="Fuzzed frames decoded with debug logging on",
+    )
+
+    parser.add_argument(
+        "--min-rate",
+        type=float,
+        default=50_000,
+        help="Minimum decode throughput, in frames per second",
+    )
+
+    main(parser.parse_args())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Many machines in one event loop
+
+Hosts simulated machines in one MachineHost and reports the memory each
+controller takes and the CPU spent handling notifications. Bleak delivers
+notifications from the event loop, which is simulated with call_soon; the
+old async callback path, one task per frame, is measured for comparison.
+
+Usage:
+    python -m benchmarks.bench_fleet [--machines N] [--rounds N]
+"""
+import argparse
+import asyncio
+import logging
+import time
+import tracemalloc
+
+from src.delonghi_controller import (
+    DEVICE_READY,
+    START_COFFEE,
+    MachineHost,
+)
+
+FRAMES = [bytearray(DEVICE_READY), bytearray(START_COFFEE)]
+
+
+def _memory_per_machine(machines):
+    """Return the bytes allocated per controller added to a host"""
+    host = MachineHost()
+    host.add('00:00:00:00:00:00')  # warm up caches shared by all machines
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for index in range(machines):
+        host.add(f'00:11:22:33:{index // 256:02X}:{index % 256:02X}')
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return allocated / machines
+
+
+async def _notification_cpu(machines, rounds, as_tasks):
+    """Return CPU seconds per notification over rounds of one frame per machine"""
+    host = MachineHost()
+    controllers = [
+        host.add(f'00:11:22:33:{index // 256:02X}:{index % 256:02X}')
+        for index in range(machines)
+    ]
+    loop = asyncio.get_running_loop()
+    start = time.process_time()
+    for round_number in range(rounds):
+        # Mostly repeated status frames, with an occasional change
+        frame = FRAMES[(round_number // 100) % 2]
+        for controller in controllers:
+            if as_tasks:
+                loop.call_soon(loop.create_task, controller._handle_data(None, frame))
+            else:
+                loop.call_soon(controller._on_notification, None, frame)
+        # Let the loop run the callbacks (and any tasks they created)
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+    elapsed = time.process_time() - start
+    await host.close()
+    return elapsed / (machines * rounds)
+
+
+def main(args: argparse.Namespace):
+    logging.disable(logging.INFO)
+
+    memory = _memory_per_machine(args.machines)
+    print(f"{'memory per machine':<28} {memory:10.0f} bytes")
+
+    for label, as_tasks in (('notification (callback)', False),
+                            ('notification (task/frame)', True)):
+        per_frame = asyncio.run(_notification_cpu(args.machines, args.rounds, as_tasks))
+        print(f"{label:<28} {per_frame * 1e6:10.2f} us CPU "
+              f"({1 / per_frame:,.0f} frames/s) with {args.machines} machines")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--machines",
+        type=int,
+        default=50,
+        help="Number of simulated machines",
+    )
+
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=2000,
+        help="Notifications per machine",
+    )
+
+    main(parser.parse_args())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Tracing overhead benchmark
+
+Measures what an instrumented span costs with tracing disabled and enabled,
+against an uninstrumented block. Exits with a non-zero status when a disabled
+span costs more than the budget.
+
+Usage:
+    python -m benchmarks.bench_tracing [--iterations N] [--budget NANOSECONDS]
+"""
+import argparse
+import sys
+import time
+
+from src.tracing import DISABLED, Tracer
+
+
+def _per_call(function, iterations):
+    """Return the mean cost of one call in nanoseconds"""
+    start = time.perf_counter_ns()
+    function(iterations)
+    return (time.perf_counter_ns() - start) / iterations
+
+
+def _bare(iterations):
+    for _ in range(iterations):
+        pass
+
+
+def _spans(tracer):
+    def run(iterations):
+        for _ in range(iterations):
+            with tracer.span('send_command', 'AA'):
+                pass
+    return run
+
+
+def main(args: argparse.Namespace):
+    bare = _per_call(_bare, args.iterations)
+    disabled = _per_call(_spans(DISABLED), args.iterations) - bare
+    enabled = _per_call(_spans(Tracer()), args.iterations) - bare
+
+    print(f"{'disabled span':<15} {disabled:8.1f} ns")
+    print(f"{'enabled span':<15} {enabled:8.1f} ns")
+
+    if disabled > args.budget:
+        print(f"disabled span costs more than {args.budget} ns: FAIL")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=200_000,
+        help="Number of spans per measurement",
+    )
+
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=1000,
+        help="Maximum cost of a disabled span, in nanoseconds",
+    )
+
+    main(parser.parse_args())
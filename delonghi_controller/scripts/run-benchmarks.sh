@@ -0,0 +1,21 @@
+#!/bin/bash
+# Run the benchmarks for the Delonghi controller
+
+set -e
+
+# Check if a specific benchmark was specified
+if [ $# -eq 0 ]; then
+  BENCHMARKS=$(cd benchmarks && ls bench_*.py | sed 's/\.py$//')
+else
+  BENCHMARKS=$1
+fi
+
+for BENCHMARK in $BENCHMARKS; do
+  echo "Running benchmark: $BENCHMARK"
+  docker run --rm -it \
+    --entrypoint python \
+    delonghi-controller \
+    -m benchmarks.$BENCHMARK
+done
+
+echo "Benchmarks completed."
@@ -0,0 +1,91 @@
+"""Spread machine connections over several Bluetooth adapters"""
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+# Consecutive failures on one adapter after which a machine moves to another
+MAX_ADAPTER_FAILURES = 3
+
+
+class AdapterPool:
+    """
+    Places each machine on one of several HCI adapters (hci0, hci1, ...).
+
+    A machine sticks to its adapter while it works. A new machine, or one that
+    failed MAX_ADAPTER_FAILURES times in a row on its adapter, goes to the
+    adapter with the fewest active links, then the best recent RSSI.
+    """
+
+    def __init__(self, adapters, max_failures=MAX_ADAPTER_FAILURES):
+        """
+        :param adapters: adapter names, e.g. ['hci0', 'hci1']
+        :raises ValueError: if no adapters are given
+        """
+        if not adapters:
+            raise ValueError('At least one adapter is required')
+        self.adapters = list(dict.fromkeys(adapters))
+        self.max_failures = max_failures
+        self._links = {adapter: set() for adapter in self.adapters}
+        self._rssi = {}          # (mac, adapter) -> last seen RSSI
+        self._failures = {}      # (mac, adapter) -> consecutive failures
+        self._assigned = {}      # mac -> adapter
+
+    def choose(self, mac):
+        """Return the adapter the machine should connect through"""
+        adapter = self._assigned.get(mac)
+        if adapter is not None and self._failures.get((mac, adapter), 0) < self.max_failures:
+            return adapter
+
+        candidates = [
+            adapter for adapter in self.adapters
+            if self._failures.get((mac, adapter), 0) < self.max_failures
+        ]
+        if not candidates:
+            # Every adapter failed; start over rather than give up on the machine
+            _LOGGER.warning('All adapters failed for %s, resetting failure counts', mac)
+            for adapter in self.adapters:
+                self._failures.pop((mac, adapter), None)
+            candidates = self.adapters
+
+        def load(adapter):
+            rssi = self._rssi.get((mac, adapter))
+            return (len(self._links[adapter]), -rssi if rssi is not None else float('inf'))
+
+        adapter = min(candidates, key=load)
+        if self._assigned.get(mac) != adapter:
+            _LOGGER.info('Placing %s on adapter %s', mac, adapter)
+        self._assigned[mac] = adapter
+        return adapter
+
+    def record_rssi(self, mac, adapter, rssi):
+        """Remember the signal strength of a machine as seen by an adapter"""
+        if rssi is not None:
+            self._rssi[(mac, adapter)] = rssi
+
+    def connected(self, mac, adapter):
+        """Count an active link"""
+        self._links[adapter].add(mac)
+
+    def succeeded(self, mac, adapter):
+        """
+        Clear the machine's failures on an adapter once a command got through;
+        a connect alone does not, as a flaky link often connects then fails
+        """
+        self._failures.pop((mac, adapter), None)
+
+    def disconnected(self, mac, adapter):
+        """Drop an active link; safe to call more than once"""
+        self._links[adapter].discard(mac)
+
+    def failed(self, mac, adapter):
+        """Count a connection or write failure of the machine on an adapter"""
+        self._links[adapter].discard(mac)
+        failures = self._failures.get((mac, adapter), 0) + 1
+        self._failures[(mac, adapter)] = failures
+        if failures >= self.max_failures:
+            _LOGGER.warning('%s failed %d times on %s, moving it to another adapter',
+                            mac, failures, adapter)
+
+    def links(self):
+        """Return the number of active links per adapter"""
+        return {adapter: len(macs) for adapter, macs in self._links.items()}
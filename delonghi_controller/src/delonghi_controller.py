@@ -1,24 +1,37 @@
 #!/usr/bin/env python3
 """Standalone Delonghi Primadonna Controller"""
-import asyncio
 import enum
+import functools
+import json
 import logging
-import uuid
+import os
 from binascii import hexlify
-import platform
-import re
 import sys
+import time
 
-from bleak import BleakClient, BleakScanner
-from bleak.exc import BleakDBusError, BleakError
+try:
+    from . import adapters, tracing
+except ImportError:  # run as a script rather than as part of the package
+    import adapters
+    import tracing
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 _LOGGER = logging.getLogger(__name__)
 
+# asyncio alone takes longer to import than the rest of the CLI, uuid pulls in
+# platform and the journal sqlite3, so, like bleak, they are only imported
+# once a machine is driven (see _load_runtime)
+asyncio = None
+uuid = None
+order_intake = None
+order_journal = None
+
+# bleak pulls in the whole D-Bus stack, so it is only imported once a BLE
+# operation actually needs it (see _load_bleak)
+BleakClient = None
+BleakScanner = None
+BleakError = None
+BleakDBusError = None
+
 # Constants from the original code
 CONTROLL_CHARACTERISTIC = "00035b03-58e6-07dd-021a-08123a000301"
 NAME_CHARACTERISTIC = "00002A00-0000-1000-8000-00805F9B34FB"
@@ -76,6 +89,7 @@ NOZZLE_STATE = {
 }
 
 DEVICE_STATUS = {
+    -1: 'UNKNOWN',
     3: 'COOKING',
     4: 'NOZZLE_DETACHED',
     5: 'OK',
@@ -112,6 +126,24 @@ START_COFFEE = [0xd0, 0x12, 0x75, 0x0f, 0x01, 0x05, 0x00, 0x00,
                 0x00, 0x5c, 0xa7]
 
 
+# Status probes
+FLEET_ENV = 'DELONGHI_MACHINES'
+FLEET_TIMEOUT = 60  # seconds
+
+# Warm-restart snapshots
+SNAPSHOT_VERSION = 1
+SNAPSHOT_INTERVAL = 10  # seconds
+STATE_DIR_ENV = 'DELONGHI_STATE_DIR'
+# 'serve' always journals, so a re-pushed order is never brewed twice
+SERVE_STATE_DIR = os.path.join('~', '.local', 'state', 'delonghi')
+
+# Further configuration read by MachineHost.from_environment and 'serve'
+ADAPTERS_ENV = 'DELONGHI_ADAPTERS'
+TRACE_ENV = 'DELONGHI_TRACE'
+INTAKE_ENV = 'DELONGHI_INTAKE'
+INTAKE_ADDRESS = '127.0.0.1:8765'
+
+
 class AvailableBeverage(enum.StrEnum):
     """Coffee machine available beverages"""
     NONE = 'none'
@@ -125,8 +157,21 @@ class AvailableBeverage(enum.StrEnum):
     ESPRESSO2 = 'espresso2'
 
 
+class BeverageParameter(enum.IntEnum):
+    """Parameter IDs in beverage start frames"""
+    TEMPERATURE = 0x00
+    COFFEE = 0x01      # coffee volume, ml
+    TASTE = 0x02       # aroma
+    DUEXPER = 0x08
+    MILK = 0x09        # milk / steam amount
+    HOT_WATER = 0x0f   # hot water volume, ml
+    ACCESSORY = 0x1c
+
+
 class BeverageCommand:
     """Coffee machine beverage commands"""
+    __slots__ = ('on', 'off')
+
     def __init__(self, on, off):
         self.on = on
         self.off = off
@@ -134,6 +179,8 @@ class BeverageCommand:
 
 class DeviceSwitches:
     """All binary switches for the device"""
+    __slots__ = ('sounds', 'energy_save', 'cup_light', 'filter', 'is_on')
+
     def __init__(self):
         self.sounds = False
         self.energy_save = False
@@ -155,6 +202,103 @@ BEVERAGE_COMMANDS = {
 }
 
 
+def _load_runtime():
+    """Import what driving machines needs on first use and bind it at module level"""
+    global asyncio, uuid, order_intake, order_journal
+    if order_journal is not None:
+        return
+    import asyncio
+    import uuid
+    try:
+        from . import order_intake, order_journal
+    except ImportError:  # run as a script rather than as part of the package
+        import order_intake
+        import order_journal
+
+
+def _load_bleak():
+    """Import bleak on first use and bind its names at module level"""
+    names = ('BleakClient', 'BleakScanner', 'BleakError', 'BleakDBusError')
+    module_globals = globals()
+    if all(module_globals[name] is not None for name in names):
+        return
+    import bleak
+    import bleak.exc
+    loaded = {
+        'BleakClient': bleak.BleakClient,
+        'BleakScanner': bleak.BleakScanner,
+        'BleakError': bleak.exc.BleakError,
+        'BleakDBusError': bleak.exc.BleakDBusError,
+    }
+    for name in names:
+        # Keep anything that was already bound, e.g. a test double
+        if module_globals[name] is None:
+            module_globals[name] = loaded[name]
+
+
+# Beverage start frames: 0x0d, length, 0x83, 0xf0, beverage ID, 0x01 (start),
+# (parameter ID, value)..., 0x06, CRC
+BEVERAGE_IDS = {
+    AvailableBeverage.ESPRESSO: 0x01,
+    AvailableBeverage.COFFEE: 0x02,
+    AvailableBeverage.LONG: 0x03,
+    AvailableBeverage.ESPRESSO2: 0x04,
+    AvailableBeverage.DOPIO: 0x05,
+    AvailableBeverage.AMERICANO: 0x06,
+    AvailableBeverage.HOTWATER: 0x10,
+    AvailableBeverage.STEAM: 0x11,
+}
+
+# Parameters sent for each beverage, as in the hand-copied *_ON frames
+BEVERAGE_DEFAULTS = {
+    AvailableBeverage.ESPRESSO: (
+        (BeverageParameter.COFFEE, 0x28), (BeverageParameter.TASTE, 0x03),
+        (BeverageParameter.DUEXPER, 0x00), (BeverageParameter.TEMPERATURE, 0x00),
+    ),
+    AvailableBeverage.COFFEE: (
+        (BeverageParameter.COFFEE, 0x67), (BeverageParameter.TASTE, 0x02),
+        (BeverageParameter.TEMPERATURE, 0x00),
+    ),
+    AvailableBeverage.LONG: (
+        (BeverageParameter.COFFEE, 0xa0), (BeverageParameter.TASTE, 0x03),
+        (BeverageParameter.TEMPERATURE, 0x00),
+    ),
+    AvailableBeverage.ESPRESSO2: (
+        (BeverageParameter.COFFEE, 0x28), (BeverageParameter.TASTE, 0x02),
+        (BeverageParameter.TEMPERATURE, 0x00),
+    ),
+    AvailableBeverage.DOPIO: (
+        (BeverageParameter.COFFEE, 0x78), (BeverageParameter.TEMPERATURE, 0x00),
+    ),
+    AvailableBeverage.AMERICANO: (
+        (BeverageParameter.COFFEE, 0x28), (BeverageParameter.TASTE, 0x03),
+        (BeverageParameter.HOT_WATER, 0x6e), (BeverageParameter.TEMPERATURE, 0x00),
+    ),
+    AvailableBeverage.HOTWATER: (
+        (BeverageParameter.HOT_WATER, 0xfa), (BeverageParameter.ACCESSORY, 0x01),
+    ),
+    AvailableBeverage.STEAM: (
+        (BeverageParameter.MILK, 0x384), (BeverageParameter.ACCESSORY, 0x01),
+    ),
+}
+
+# Parameters with a two byte, big-endian value; the others take one byte
+WIDE_PARAMETERS = frozenset({
+    BeverageParameter.COFFEE, BeverageParameter.MILK, BeverageParameter.HOT_WATER,
+})
+
+# Keyword names accepted by beverage_start_frame
+BEVERAGE_PARAMETER_NAMES = {
+    'volume': BeverageParameter.COFFEE,
+    'aroma': BeverageParameter.TASTE,
+    'water': BeverageParameter.HOT_WATER,
+    'milk': BeverageParameter.MILK,
+    'temperature': BeverageParameter.TEMPERATURE,
+}
+
+BEVERAGE_FRAME_CACHE_SIZE = 256
+
+
 def sign_request(message):
     """Request signer for the new command format"""
     deviser = 0x1D0F
@@ -169,16 +313,83 @@ def sign_request(message):
     return message
 
 
+# typed, so volume=True is not served the cached frame for volume=1
+@functools.lru_cache(maxsize=BEVERAGE_FRAME_CACHE_SIZE, typed=True)
+def beverage_start_frame(beverage: AvailableBeverage, **parameters) -> bytes:
+    """
+    Build the signed start frame for a beverage
+    :param parameters: overrides of the beverage defaults, by name (see
+        BEVERAGE_PARAMETER_NAMES); None keeps the default
+    :raises ValueError: for an unknown beverage or parameter, a parameter
+        the beverage does not take, or a value which does not fit the frame
+    """
+    if beverage not in BEVERAGE_IDS:
+        raise ValueError(f'Beverage {beverage} has no start frame')
+    values = dict(BEVERAGE_DEFAULTS[beverage])
+    for name, value in parameters.items():
+        if name not in BEVERAGE_PARAMETER_NAMES:
+            raise ValueError(f'Unknown beverage parameter: {name}')
+        parameter = BEVERAGE_PARAMETER_NAMES[name]
+        # Only the fields the machine sends for this beverage may be changed
+        if parameter not in values:
+            raise ValueError(f'Beverage {beverage} does not take {name}')
+        if value is not None:
+            values[parameter] = value
+
+    frame = [0x0d, 0x00, 0x83, 0xf0, BEVERAGE_IDS[beverage], 0x01]
+    for parameter, value in values.items():
+        width = 2 if parameter in WIDE_PARAMETERS else 1
+        if (isinstance(value, bool) or not isinstance(value, int)
+                or not 0 <= value < 1 << (8 * width)):
+            raise ValueError(f'Invalid value for {parameter.name}: {value!r}')
+        frame.append(parameter)
+        frame.extend(value.to_bytes(width, byteorder='big'))
+    frame.extend((0x06, 0x00, 0x00))
+    frame[1] = len(frame) - 1
+    return bytes(sign_request(frame))
+
+
 class DelongiPrimadonna:
-    """Delongi Primadonna standalone class"""
+    """
+    Delongi Primadonna standalone class
+
+    All state lives on the instance, so one event loop can drive many
+    machines (see MachineHost).
+    """
 
-    def __init__(self, mac, name="Delonghi Coffee Machine"):
-        """Initialize device"""
+    __slots__ = (
+        '_device_status', '_client', '_device', '_connecting', '_connect_lock',
+        '_snapshot_path', '_saved_snapshot', '_journal', '_adapter_pool', '_adapter',
+        '_tracer', '_finish_waiters', '_frames', 'mac', 'name', 'hostname', 'model', 'cooking', 'connected',
+        'steam_nozzle', 'service', 'status', 'switches', 'stale', 'in_flight',
+    )
+
+    def __init__(self, mac, name="Delonghi Coffee Machine", snapshot_path=None, journal=None,
+                 adapter_pool=None, tracer=None):
+        """
+        Initialize device
+        :param snapshot_path: file to persist state to; a snapshot already
+            there is loaded as stale state until the device confirms it
+        :param journal: OrderJournal which makes dispatch() idempotent
+        :param adapter_pool: AdapterPool, usually shared between machines,
+            which picks the Bluetooth adapter; the default adapter if None
+        :param tracer: tracing.Tracer recording connection and command spans
+        """
         _LOGGER.debug("Initializing DelongiPrimadonna with MAC: %s, name: %s", mac, name)
+        _load_runtime()
         self._device_status = None
         self._client = None
         self._device = None
         self._connecting = False
+        self._connect_lock = asyncio.Lock()
+        self._snapshot_path = snapshot_path
+        self._saved_snapshot = None
+        self._journal = journal
+        self._adapter_pool = adapter_pool
+        self._adapter = None
+        self._tracer = tracer or tracing.DISABLED
+        self._finish_waiters = []
+        self._frames = 0  # notifications received, to wait for a fresh one
         self.mac = mac
         self.name = name
         self.hostname = ''
@@ -187,12 +398,152 @@ class DelongiPrimadonna:
         self.connected = False
         self.steam_nozzle = NOZZLE_STATE[-1]
         self.service = 0
-        self.status = DEVICE_STATUS[5]
+        self.status = DEVICE_STATUS[-1]
         self.switches = DeviceSwitches()
+        # True until a frame from the device confirms the state above
+        self.stale = True
+        # Last command which changes what the machine is doing, if unfinished
+        self.in_flight = None
+        if snapshot_path is not None:
+            self.load_snapshot()
+
+    def as_dict(self):
+        """Return the known device state as a JSON-serialisable dict"""
+        return {
+            'mac': self.mac,
+            'hostname': self.hostname,
+            'model': self.model,
+            'connected': self.connected,
+            'status': self.status,
+            'steam_nozzle': self.steam_nozzle,
+            'service': self.service,
+            'cooking': str(self.cooking),
+            'switches': {
+                'is_on': self.switches.is_on,
+                'sounds': self.switches.sounds,
+                'energy_save': self.switches.energy_save,
+                'cup_light': self.switches.cup_light,
+                'filter': self.switches.filter,
+            },
+            'raw': self._device_status.hex(' ') if self._device_status else None,
+            'stale': self.stale,
+        }
+
+    def snapshot(self):
+        """
+        Return the compact state persisted for warm restarts. The resolved BLE
+        device is not kept: connecting by address alone scans again anyway
+        """
+        return {
+            'version': SNAPSHOT_VERSION,
+            'mac': self.mac,
+            'hostname': self.hostname,
+            'status': self.status,
+            'steam_nozzle': self.steam_nozzle,
+            'service': self.service,
+            'cooking': str(self.cooking),
+            'switches': self.as_dict()['switches'],
+            'in_flight': self.in_flight,
+        }
+
+    def save_snapshot(self):
+        """
+        Persist the state snapshot if it changed since the last save
+        :return: True if the snapshot file was written
+        """
+        if self._snapshot_path is None:
+            return False
+        data = json.dumps(self.snapshot(), separators=(',', ':'))
+        if data == self._saved_snapshot:
+            return False
+        temp_path = f'{self._snapshot_path}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as snapshot_file:
+                snapshot_file.write(data)
+            # Atomic, so a crash mid-write never leaves a truncated snapshot
+            os.replace(temp_path, self._snapshot_path)
+        except OSError as error:
+            _LOGGER.warning('Could not save snapshot to %s: %s', self._snapshot_path, error)
+            return False
+        self._saved_snapshot = data
+        return True
+
+    def load_snapshot(self):
+        """
+        Restore state from the snapshot file and mark it stale
+        :return: True if a snapshot was loaded
+        """
+        try:
+            with open(self._snapshot_path, encoding='utf-8') as snapshot_file:
+                data = json.load(snapshot_file)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as error:
+            _LOGGER.warning('Ignoring unreadable snapshot %s: %s', self._snapshot_path, error)
+            return False
+        if data.get('version') != SNAPSHOT_VERSION or data.get('mac') != self.mac:
+            _LOGGER.warning('Ignoring snapshot %s for another version or device', self._snapshot_path)
+            return False
+        try:
+            self.hostname = data['hostname']
+            self.status = data['status']
+            self.steam_nozzle = data['steam_nozzle']
+            self.service = data['service']
+            self.cooking = AvailableBeverage(data['cooking'])
+            for switch, value in data['switches'].items():
+                setattr(self.switches, switch, value)
+            self.in_flight = data['in_flight']
+        except (AttributeError, KeyError, TypeError, ValueError) as error:
+            _LOGGER.warning('Ignoring malformed snapshot %s: %s', self._snapshot_path, error)
+            return False
+        self.stale = True
+        self._saved_snapshot = json.dumps(data, separators=(',', ':'))
+        _LOGGER.info('Loaded stale snapshot for %s: status %s, in flight %s',
+                     self.mac, self.status, self.in_flight)
+        return True
+
+    async def reconcile(self, timeout=FLEET_TIMEOUT):
+        """
+        Refresh stale state from the device and settle the in-flight command.
+
+        Orders journaled for this machine before the call which it is no
+        longer brewing are journaled as interrupted, so they can be
+        dispatched again or left cancelled.
+        :return: the in-flight command if the machine is no longer running it,
+            i.e. it finished or was interrupted while we were not watching
+        """
+        started_at = time.time()
+        in_flight = self.in_flight
+        deadline = asyncio.get_running_loop().time() + timeout
+        if not await probe_status(self, deadline):
+            _LOGGER.warning('Could not reconcile state of %s', self.mac)
+            return None
+        unfinished = None
+        # Leave alone a command issued while we were reconciling
+        if (in_flight is not None and self.in_flight is in_flight
+                and self.status != DEVICE_STATUS[3]):
+            # The machine is no longer brewing what we last asked for
+            unfinished = self.in_flight
+            _LOGGER.warning('In-flight command is no longer running: %s', unfinished)
+            self._record_order(order_journal.INTERRUPTED)
+            self.in_flight = None
+            self.cooking = AvailableBeverage.NONE
+            self._wake_finish_waiters()
+        if self._journal is not None:
+            # Also settle orders the snapshot missed, e.g. after a crash
+            # between journaling a dispatch and saving the snapshot
+            current = self.in_flight.get('order_id') if self.in_flight else None
+            for order in self._journal.in_flight(self.mac):
+                if order['order_id'] != current and order['at'] < started_at:
+                    _LOGGER.warning('Order %s is no longer running', order['order_id'])
+                    self._journal.record(order['order_id'], order_journal.INTERRUPTED)
+        self.save_snapshot()
+        return unfinished
 
     async def disconnect(self):
         """Disconnect from the device"""
         _LOGGER.info('Disconnect from %s', self.mac)
+        self.save_snapshot()
         try:
             if (self._client is not None) and self._client.is_connected:
                 await self._client.disconnect()
@@ -204,36 +555,103 @@ class DelongiPrimadonna:
             # Even if disconnect fails, consider the client disconnected
             self.connected = False
             self._client = None
+        if self._adapter is not None:
+            self._adapter_pool.disconnected(self.mac, self._adapter)
+
+    def _client_disconnected(self, adapter, client):
+        """Release the adapter link when the device drops the connection"""
+        _LOGGER.info('%s disconnected from adapter %s', self.mac, adapter)
+        self.connected = False
+        self._adapter_pool.disconnected(self.mac, adapter)
+
+    def _adapter_failed(self):
+        """Count a failure against the adapter in use, if any"""
+        if self._adapter is not None:
+            self._adapter_pool.failed(self.mac, self._adapter)
+
+    async def _write_failed(self):
+        """
+        Count a failed write against the adapter and drop the client, so the
+        next command connects afresh and the pool may pick another adapter
+        """
+        self.connected = False
+        self._adapter_failed()
+        client, self._client = self._client, None
+        if client is not None:
+            try:
+                await client.disconnect()
+            except Exception as error:
+                _LOGGER.debug('Error dropping the client of %s: %s', self.mac, error)
+
+    async def _find_device_on_adapter(self, adapter):
+        """Scan for the device through one adapter, recording its RSSI"""
+        mac = self.mac.upper()
+
+        def match(device, advertisement_data):
+            if device.address.upper() != mac:
+                return False
+            self._adapter_pool.record_rssi(self.mac, adapter, advertisement_data.rssi)
+            return True
+
+        return await BleakScanner.find_device_by_filter(match, bluez={'adapter': adapter})
 
     async def _connect(self):
         """
         Connect to the device
         :raises BleakError: if the device is not found
         """
-        self._connecting = True
-        try:
-            if (self._client is None) or (not self._client.is_connected):
-                # First try to connect directly with the MAC address
-                self._device = await BleakScanner.find_device_by_address(self.mac)
-                
-                if not self._device:
-                    _LOGGER.error('Device with address %s not found', self.mac)
-                    raise BleakError(
-                        f'A device with address {self.mac} could not be found.'
-                    )
-                    
-                self._client = BleakClient(self._device)
-                _LOGGER.info('Connect to %s', self.mac)
-                await self._client.connect()
-                await self._client.start_notify(
-                    uuid.UUID(CONTROLL_CHARACTERISTIC), self._handle_data
-                )
-                self.connected = True
-        except Exception as error:
+        _load_bleak()
+        with self._tracer.span('connect', self.mac):
+            await self._connect_locked()
+
+    async def _connect_locked(self):
+        """Connect to the device unless connected, one caller at a time"""
+        tracer = self._tracer
+        # Serialise connects, e.g. a background reconcile and a command
+        async with self._connect_lock:
+            self._connecting = True
+            try:
+                if (self._client is None) or (not self._client.is_connected):
+                    if self._adapter_pool is not None:
+                        self._adapter = self._adapter_pool.choose(self.mac)
+                        with tracer.span('find_device_by_filter', self.mac, adapter=self._adapter):
+                            self._device = await self._find_device_on_adapter(self._adapter)
+                    else:
+                        # First try to connect directly with the MAC address
+                        with tracer.span('find_device_by_address', self.mac):
+                            self._device = await BleakScanner.find_device_by_address(self.mac)
+
+                    if not self._device:
+                        _LOGGER.error('Device with address %s not found', self.mac)
+                        raise BleakError(
+                            f'A device with address {self.mac} could not be found.'
+                        )
+
+                    if self._adapter is not None:
+                        self._client = BleakClient(
+                            self._device,
+                            functools.partial(self._client_disconnected, self._adapter),
+                            bluez={'adapter': self._adapter},
+                        )
+                        _LOGGER.info('Connect to %s through %s', self.mac, self._adapter)
+                    else:
+                        self._client = BleakClient(self._device)
+                        _LOGGER.info('Connect to %s', self.mac)
+                    with tracer.span('client.connect', self.mac):
+                        await self._client.connect()
+                    with tracer.span('start_notify', self.mac):
+                        await self._client.start_notify(
+                            uuid.UUID(CONTROLL_CHARACTERISTIC), self._on_notification
+                        )
+                    self.connected = True
+                    if self._adapter is not None:
+                        self._adapter_pool.connected(self.mac, self._adapter)
+            except Exception as error:
+                self._connecting = False
+                self.connected = False
+                self._adapter_failed()
+                raise error
             self._connecting = False
-            self.connected = False
-            raise error
-        self._connecting = False
 
     def _make_switch_command(self):
         """Make hex command"""
@@ -250,7 +668,26 @@ class DelongiPrimadonna:
 
     async def _handle_data(self, sender, value):
         """Handle data received from the device"""
-        _LOGGER.debug('Received raw data from %s: %s', sender, hexlify(value, ' '))
+        self._on_notification(sender, value)
+
+    def _on_notification(self, sender, value):
+        """
+        Decode a notification frame into the device state.
+
+        Registered as a plain callback, so bleak calls it inline instead of
+        scheduling a task per frame; it allocates nothing for a frame equal
+        to the previous one unless debug logging or tracing is on.
+        """
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug('Received raw data from %s: %s', sender, hexlify(value, ' '))
+        # A status from the snapshot was not seen by us; reconcile() settles it
+        was_stale = self.stale
+        self.stale = False
+        self._frames += 1
+        previous_status = self.status
+        order_id = self.in_flight.get('order_id') if self.in_flight else None
+        if self._tracer.enabled:
+            self._tracer.instant('notification', self.mac, frame=value.hex(' '), order_id=order_id)
         
         # Handle long format responses (legacy format)
         if len(value) > 9:
@@ -278,7 +715,8 @@ class DelongiPrimadonna:
         
         # Handle short format responses (3 bytes) - newer format used by this machine
         elif len(value) == 3:
-            _LOGGER.debug('Processing 3-byte status response: %s', hexlify(value, ' '))
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug('Processing 3-byte status response: %s', hexlify(value, ' '))
             
             # Parse first byte (value[0]) for basic status
             if value[0] != 0:
@@ -310,10 +748,21 @@ class DelongiPrimadonna:
             # Parse third byte (value[2]) - might contain additional state info
             # For now, just log it for analysis
             _LOGGER.debug('Third byte value: 0x%02x', value[2])
-            
-        if self._device_status != hexlify(value, ' '):
-            _LOGGER.info('Received data: %s from %s', hexlify(value, ' '), sender)
-        self._device_status = hexlify(value, ' ')
+
+        if self._tracer.enabled and self.status != previous_status:
+            self._tracer.instant(f'status {self.status}', self.mac, order_id=order_id)
+
+        if (self.in_flight is not None and not was_stale
+                and previous_status == DEVICE_STATUS[3] and self.status != DEVICE_STATUS[3]):
+            _LOGGER.info('In-flight command finished: %s', self.in_flight)
+            self._record_order(order_journal.DONE)
+            self.in_flight = None
+            self._wake_finish_waiters()
+
+        # Keep the last frame as raw bytes; only a changed frame is copied
+        if self._device_status != value:
+            self._device_status = bytes(value)
+            _LOGGER.info('Received data: %s from %s', self._device_status.hex(' '), sender)
 
     async def power_on(self) -> None:
         """Turn the device on."""
@@ -356,11 +805,135 @@ class DelongiPrimadonna:
         self.switches.sounds = False
         await self.send_command(self._make_switch_command())
 
-    async def beverage_start(self, beverage: AvailableBeverage) -> None:
-        """Start beverage"""
+    async def beverage_start(self, beverage: AvailableBeverage, order_id=None,
+                             parameters=None) -> bool:
+        """
+        Start beverage
+        :param order_id: order the beverage is for, kept with the in-flight command
+        :param parameters: beverage_start_frame overrides, e.g. {'volume': 60}
+        :return: True if the start command was sent
+        :raises ValueError: for invalid parameters
+        """
+        if beverage in BEVERAGE_IDS:
+            frame = beverage_start_frame(beverage, **(parameters or {}))
+        else:
+            frame = BEVERAGE_COMMANDS.get(beverage).on
         _LOGGER.info('Starting beverage: %s', beverage)
         self.cooking = beverage
-        await self.send_command(BEVERAGE_COMMANDS.get(beverage).on)
+        self.in_flight = {
+            'command': 'beverage_start',
+            'beverage': str(beverage),
+            'order_id': order_id,
+            'started_at': time.time(),
+        }
+        self.save_snapshot()
+        return await self.send_command(frame)
+
+    async def dispatch(self, beverage: AvailableBeverage, order_id, parameters=None) -> str:
+        """
+        Start a beverage for an order, at most once per order ID
+        :param parameters: beverage_start_frame overrides, e.g. {'volume': 60}
+        :return: the order state, 'started' or 'failed', or for a duplicate
+            the state the order was already in
+        :raises ValueError: for invalid parameters, before anything is journaled
+        :raises BleakError: if the device cannot be reached; the order is
+            journaled as failed, so it may be dispatched again
+        """
+        if beverage in BEVERAGE_IDS:
+            beverage_start_frame(beverage, **(parameters or {}))
+        token = tracing.current_order.set(order_id)
+        try:
+            with self._tracer.span('dispatch', self.mac, beverage=str(beverage)):
+                if self._journal is not None:
+                    if not self._journal.begin(order_id, self.mac, str(beverage)):
+                        return self._journal.state(order_id)
+                try:
+                    sent = await self.beverage_start(beverage, order_id, parameters)
+                except Exception:
+                    # E.g. the device was not found. A cancellation is left
+                    # in flight for reconcile(), as the command may be out
+                    self._dispatch_failed(order_id)
+                    raise
+                if not sent:
+                    self._dispatch_failed(order_id)
+                    return order_journal.FAILED
+                self._record_order(order_journal.STARTED)
+                return order_journal.STARTED
+        finally:
+            tracing.current_order.reset(token)
+
+    def _dispatch_failed(self, order_id):
+        """Journal an order whose start command was not sent, and forget it"""
+        if self._journal is not None:
+            self._journal.record(order_id, order_journal.FAILED)
+        self.in_flight = None
+        self.save_snapshot()
+
+    async def wait_finished(self, timeout):
+        """
+        Wait until the in-flight command finishes or is cancelled
+        :return: True once it did, False if it was still running after timeout
+        """
+        if self.in_flight is None:
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        self._finish_waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if waiter in self._finish_waiters:
+                self._finish_waiters.remove(waiter)
+        return True
+
+    def _wake_finish_waiters(self):
+        """Resolve wait_finished() calls once the in-flight command ended"""
+        waiters, self._finish_waiters = self._finish_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def settle_in_flight(self, state):
+        """Journal the in-flight order as state and stop waiting for it"""
+        self._record_order(state)
+        self.in_flight = None
+        self.cooking = AvailableBeverage.NONE
+        self._wake_finish_waiters()
+        self.save_snapshot()
+
+    @property
+    def brewing(self):
+        """Whether the machine last reported it is brewing"""
+        return self.status == DEVICE_STATUS[3]
+
+    async def request_status(self, timeout):
+        """
+        Ask the machine for its status and wait for the answer, e.g. in case
+        the notification which ended a brew was missed
+        :return: True if a status frame arrived within timeout
+        """
+        frames = self._frames
+        try:
+            async with asyncio.timeout(timeout):
+                if not await self.send_command(DEBUG):
+                    return False
+                while self._frames == frames:
+                    await asyncio.sleep(0.1)
+        except TimeoutError:
+            return False
+        except Exception as error:  # e.g. BleakError: the device was not found
+            _LOGGER.warning('Could not request the status of %s: %s', self.mac, error)
+            return False
+        return True
+
+    def _record_order(self, state):
+        """Journal a state change of the in-flight order, if there is one"""
+        if self._journal is None or self.in_flight is None:
+            return
+        order_id = self.in_flight.get('order_id')
+        if order_id is not None:
+            self._journal.record(order_id, state)
 
     async def beverage_cancel(self) -> None:
         """Cancel beverage"""
@@ -368,6 +941,10 @@ class DelongiPrimadonna:
             _LOGGER.info('Cancelling beverage: %s', self.cooking)
             await self.send_command(BEVERAGE_COMMANDS.get(self.cooking).off)
             self.cooking = AvailableBeverage.NONE
+            self._record_order(order_journal.CANCELLED)
+            self.in_flight = None
+            self._wake_finish_waiters()
+            self.save_snapshot()
         else:
             _LOGGER.debug('No beverage in progress to cancel')
 
@@ -381,6 +958,7 @@ class DelongiPrimadonna:
         Get device name
         :return: device name
         """
+        _load_bleak()
         try:
             await self._connect()
             try:
@@ -412,232 +990,713 @@ class DelongiPrimadonna:
         except asyncio.exceptions.CancelledError as error:
             self.connected = False
             _LOGGER.warning('CancelledError: %s', error)
+            # Let the cancellation reach the caller, e.g. a probe deadline
+            raise
         return None
 
     async def send_command(self, message):
-        """Send command to the device"""
-        _LOGGER.debug('Preparing to send command to %s', self.mac)
-        await self._connect()
-        try:
-            message_copy = message.copy()  # Create a copy to avoid modifying the original
-            sign_request(message_copy)
-            _LOGGER.info('Sending command: %s', hexlify(bytearray(message_copy), ' '))
-            await self._client.write_gatt_char(
-                uuid.UUID(CONTROLL_CHARACTERISTIC), bytearray(message_copy)
+        """
+        Send command to the device
+        :param message: list of bytes to sign and send, or an already signed
+            bytes frame such as one from beverage_start_frame
+        """
+        with self._tracer.span('send_command', self.mac):
+            _LOGGER.debug('Preparing to send command to %s', self.mac)
+            _load_bleak()
+            await self._connect()
+            try:
+                if isinstance(message, bytes):
+                    message_copy = message
+                else:
+                    message_copy = message.copy()  # Create a copy to avoid modifying the original
+                    sign_request(message_copy)
+                _LOGGER.info('Sending command: %s', hexlify(bytearray(message_copy), ' '))
+                await self._client.write_gatt_char(
+                    uuid.UUID(CONTROLL_CHARACTERISTIC), bytearray(message_copy)
+                )
+                _LOGGER.debug('Command sent successfully')
+                if self._adapter is not None:
+                    self._adapter_pool.succeeded(self.mac, self._adapter)
+                return True
+            except BleakError as error:
+                await self._write_failed()
+                _LOGGER.warning('BleakError while sending command: %s', error)
+                return False
+            except Exception as error:
+                await self._write_failed()
+                _LOGGER.error('Unexpected error while sending command: %s', error, exc_info=True)
+                return False
+
+
+class MachineHost:
+    """
+    Many DelongiPrimadonna controllers in one event loop, sharing the order
+    journal, adapter pool and tracer, with one task persisting all snapshots
+    """
+    __slots__ = ('machines', 'journal', 'adapter_pool', 'tracer', 'state_dir',
+                 'trace_path', '_tasks')
+
+    def __init__(self, state_dir=None, journal=None, adapter_pool=None, tracer=None,
+                 trace_path=None):
+        """
+        :param state_dir: directory for per-machine snapshots, None for none
+        :param trace_path: file the tracer is exported to on close(), and
+            each snapshot interval while it records events
+        """
+        _load_runtime()
+        self.machines = {}
+        self.state_dir = state_dir
+        self.journal = journal
+        self.adapter_pool = adapter_pool
+        self.tracer = tracer
+        self.trace_path = trace_path
+        self._tasks = []
+
+    @classmethod
+    def from_environment(cls, state_dir=None):
+        """
+        Configure a host from DELONGHI_STATE_DIR, _ADAPTERS and _TRACE
+        :param state_dir: state directory to use instead of DELONGHI_STATE_DIR
+        """
+        _load_runtime()
+        state_dir = state_dir or os.environ.get(STATE_DIR_ENV) or None
+        adapter_names = os.environ.get(ADAPTERS_ENV, '').replace(',', ' ').split()
+        trace_path = os.environ.get(TRACE_ENV) or None
+        return cls(
+            state_dir=state_dir,
+            journal=(order_journal.OrderJournal(os.path.join(state_dir, 'journal.sqlite3'))
+                     if state_dir else None),
+            adapter_pool=adapters.AdapterPool(adapter_names) if adapter_names else None,
+            tracer=tracing.Tracer() if trace_path else None,
+            trace_path=trace_path,
+        )
+
+    def add(self, mac, name="Delonghi Coffee Machine"):
+        """Return the controller for a machine, creating it on first use"""
+        machine = self.machines.get(mac)
+        if machine is None:
+            snapshot_path = None
+            if self.state_dir is not None:
+                snapshot_path = os.path.join(
+                    self.state_dir, mac.replace(':', '').lower() + '.json'
+                )
+            machine = DelongiPrimadonna(
+                mac, name, snapshot_path=snapshot_path, journal=self.journal,
+                adapter_pool=self.adapter_pool, tracer=self.tracer,
             )
-            _LOGGER.debug('Command sent successfully')
+            self.machines[mac] = machine
+            if self.journal is not None:
+                for order in self.journal.in_flight(mac):
+                    _LOGGER.warning('Order %s (%s) was %s but never finished',
+                                    order['order_id'], order['command'], order['state'])
+            if self._tasks and self._needs_reconcile(machine):
+                self._tasks.append(asyncio.create_task(self._reconcile(machine)))
+        return machine
+
+    def start(self, interval=SNAPSHOT_INTERVAL):
+        """
+        Start persisting snapshots, and reconciling machines whose brew was
+        in flight before a restart, in the background
+        """
+        self._tasks.append(asyncio.create_task(self._persist_snapshots(interval)))
+        for machine in self.machines.values():
+            if self._needs_reconcile(machine):
+                # Find out whether the brew from before the restart is still running
+                self._tasks.append(asyncio.create_task(self._reconcile(machine)))
+
+    async def close(self):
+        """Stop background work, disconnect every machine and export the trace"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await asyncio.gather(
+            *(machine.disconnect() for machine in self.machines.values()),
+            return_exceptions=True,
+        )
+        if self.journal is not None:
+            self.journal.close()
+        if self._export_trace():
+            _LOGGER.info('Wrote trace to %s', self.trace_path)
+
+    def _export_trace(self):
+        """Write the trace if there is one with new events; return whether written"""
+        if self.tracer is None or self.trace_path is None or not self.tracer.changed:
+            return False
+        try:
+            self.tracer.export(self.trace_path)
+        except OSError as error:
+            _LOGGER.warning('Could not write trace to %s: %s', self.trace_path, error)
+            return False
+        return True
+
+    def _needs_reconcile(self, machine):
+        """Whether a brew or journaled order of the machine is unsettled"""
+        if machine.in_flight is not None:
             return True
-        except BleakError as error:
-            self.connected = False
-            _LOGGER.warning('BleakError while sending command: %s', error)
+        return self.journal is not None and bool(self.journal.in_flight(machine.mac))
+
+    async def _reconcile(self, machine):
+        """Reconcile a machine and report an order it no longer brews"""
+        unfinished = await machine.reconcile()
+        if unfinished is not None and unfinished.get('order_id') is not None:
+            _LOGGER.warning('Order %s was interrupted; dispatch it again to resume it',
+                            unfinished['order_id'])
+
+    async def _persist_snapshots(self, interval):
+        """Save every machine's snapshot, and the trace, each interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            for machine in self.machines.values():
+                machine.save_snapshot()
+            # A crash then loses at most one interval of the trace
+            self._export_trace()
+
+
+USAGE = "Usage: python delonghi_controller.py <MAC_ADDRESS> [command] [option]"
+
+
+async def _status(coffee_machine, option, order_id):
+    """Connect, request a status frame and print the decoded state"""
+    print(f"Attempting to connect to device: {coffee_machine.mac}")
+
+    # Try to connect and get device name
+    connection_attempts = 0
+    max_attempts = 3
+    while connection_attempts < max_attempts:
+        connection_attempts += 1
+        try:
+            print(f"Connection attempt {connection_attempts}/{max_attempts}...")
+            name = await coffee_machine.get_device_name()
+            if name:
+                print(f"✓ Connected successfully to: {name}")
+                break
+            else:
+                print("× Connection failed, retrying...")
+                await asyncio.sleep(1)
+        except Exception as e:
+            print(f"× Connection error: {e}")
+            if connection_attempts < max_attempts:
+                print("Retrying connection...")
+                await asyncio.sleep(2)
+
+    if not coffee_machine.connected:
+        print("Failed to connect to the coffee machine after multiple attempts.")
+        print("Please check:")
+        print("- The MAC address is correct")
+        print("- The coffee machine is powered on")
+        print("- Bluetooth is enabled on your device")
+        print("- You have the necessary permissions (try running with sudo on Linux)")
+        return
+
+    # Request status update
+    print("Requesting device status...")
+    await coffee_machine.debug()
+
+    # Wait for status updates to be received via notifications
+    print("Waiting for status updates (up to 60 seconds)...")
+
+    # Wait up to 60 seconds for a response
+    max_wait_time = 60  # seconds
+    wait_interval = 2   # check every 2 seconds
+    waited_time = 0
+
+    while waited_time < max_wait_time:
+        if coffee_machine._device_status:  # If we've received status data
+            break
+
+        # Print a waiting message every 10 seconds
+        if waited_time % 10 == 0 and waited_time > 0:
+            print(f"Still waiting for response... ({waited_time} seconds elapsed)")
+
+        await asyncio.sleep(wait_interval)
+        waited_time += wait_interval
+
+    # Only display status information if we received data
+    if coffee_machine._device_status:
+        print("\n=== COFFEE MACHINE STATUS ===")
+        print(f"Device name: {coffee_machine.hostname}")
+        print(f"MAC address: {coffee_machine.mac}")
+        print(f"Model: {coffee_machine.model}")
+        print(f"Power state: {'ON' if coffee_machine.switches.is_on else 'OFF'}")
+        print(f"Machine status: {coffee_machine.status}")
+        print(f"Steam nozzle state: {coffee_machine.steam_nozzle}")
+        print(f"Currently brewing: {coffee_machine.cooking}")
+        print(f"Service value: {coffee_machine.service}")
+        print("\n=== SETTINGS ===")
+        print(f"Cup light: {'ON' if coffee_machine.switches.cup_light else 'OFF'}")
+        print(f"Energy save mode: {'ON' if coffee_machine.switches.energy_save else 'OFF'}")
+        print(f"Sound alerts: {'ON' if coffee_machine.switches.sounds else 'OFF'}")
+        print(f"\nRaw status data: {coffee_machine._device_status.hex(' ')}")
+    else:
+        print("\nNo status data received after waiting 60 seconds.")
+        print("The machine may be powered off, in deep sleep mode, or not responding.")
+        print("Try sending a power command first: python delonghi_controller.py <MAC_ADDRESS> power")
+
+
+async def _power(coffee_machine, option, order_id):
+    """Power the machine on, or cancel brewing for 'off'"""
+    if option == "off":
+        # Power off is not directly supported, but we can cancel any brewing
+        await coffee_machine.beverage_cancel()
+        print("Cancelled brewing (note: machine may still be powered on)")
+    else:
+        await coffee_machine.power_on()
+        print("Power on command sent")
+        # Wait for status update
+        await asyncio.sleep(2)
+
+
+def parse_beverage_parameters(option):
+    """
+    Parse a beverage command option into beverage_start_frame overrides
+    :param option: None, a dict, or a string like 'volume=60,aroma=4'
+    :raises ValueError: on malformed options or unknown parameters
+    """
+    if option is None:
+        return {}
+    if isinstance(option, dict):
+        parameters = dict(option)
+    else:
+        parameters = {}
+        for item in str(option).split(','):
+            name, separator, value = item.partition('=')
+            if not separator:
+                raise ValueError(f"expected 'name=value' beverage parameters, got {item!r}")
+            try:
+                parameters[name.strip()] = int(value, 0)
+            except ValueError as error:
+                raise ValueError(f"invalid value for {name.strip()}: {value!r}") from error
+    for name in parameters:
+        if name not in BEVERAGE_PARAMETER_NAMES:
+            raise ValueError(f"unknown beverage parameter: {name}")
+    return parameters
+
+
+def _brew(beverage, message):
+    """Build a command handler which starts the given beverage"""
+    async def handler(coffee_machine, option, order_id):
+        parameters = parse_beverage_parameters(option)
+        if order_id is not None:
+            state = await coffee_machine.dispatch(beverage, order_id, parameters)
+            if state != order_journal.STARTED:
+                print(f"Order {order_id} not started: {state}")
+                return
+        else:
+            await coffee_machine.beverage_start(beverage, parameters=parameters)
+        print(message)
+        coffee_machine.cooking = beverage  # Update local state
+        # Wait for status update
+        await asyncio.sleep(2)
+    handler.beverage = beverage
+    return handler
+
+
+def validate_step(command, option):
+    """
+    Check a command's option before anything is sent
+    :raises ValueError: if the command or its option is invalid
+    """
+    if command not in COMMANDS:
+        raise ValueError(f"unknown command: {command}")
+    beverage = getattr(COMMANDS[command][0], 'beverage', None)
+    if beverage is not None:
+        beverage_start_frame(beverage, **parse_beverage_parameters(option))
+
+
+def beverage_order(command, option):
+    """
+    Resolve an intake order's beverage and parameters for dispatch()
+    :param command: beverage command name, e.g. 'espresso'
+    :param option: beverage parameters as accepted by parse_beverage_parameters
+    :raises ValueError: for an unknown beverage or invalid parameters
+    """
+    handler = COMMANDS.get(command, (None,))[0] if isinstance(command, str) else None
+    beverage = getattr(handler, 'beverage', None)
+    if beverage is None:
+        raise ValueError(f"unknown beverage: {command}")
+    validate_step(command, option)
+    return beverage, parse_beverage_parameters(option)
+
+
+async def _cancel(coffee_machine, option, order_id):
+    """Cancel the beverage in progress"""
+    await coffee_machine.beverage_cancel()
+    print("Cancelled brewing")
+    coffee_machine.cooking = AvailableBeverage.NONE  # Update local state
+    # Wait for status update
+    await asyncio.sleep(2)
+
+
+async def _orders(coffee_machine, option, order_id):
+    """Print the orders dispatched to this machine which never finished"""
+    journal = coffee_machine._journal
+    print(json.dumps({
+        'in_flight': journal.in_flight(coffee_machine.mac) if journal else [],
+        'interrupted': journal.interrupted(coffee_machine.mac) if journal else [],
+    }, indent=2))
+
+
+# CLI command name -> (handler, help text)
+COMMANDS = {
+    'status': (_status, 'Get the current status of the coffee machine'),
+    'power': (_power, "Toggle power (use 'on' or 'off' as option)"),
+    'espresso': (_brew(AvailableBeverage.ESPRESSO, "Making espresso"), 'Make an espresso'),
+    'coffee': (_brew(AvailableBeverage.COFFEE, "Making coffee"), 'Make a coffee'),
+    'americano': (_brew(AvailableBeverage.AMERICANO, "Making americano"), 'Make an americano'),
+    'long': (_brew(AvailableBeverage.LONG, "Making long coffee"), 'Make a long coffee'),
+    'doppio': (_brew(AvailableBeverage.DOPIO, "Making doppio"), 'Make a doppio'),
+    'hotwater': (_brew(AvailableBeverage.HOTWATER, "Dispensing hot water"), 'Dispense hot water'),
+    'steam': (_brew(AvailableBeverage.STEAM, "Activating steam"), 'Activate steam'),
+    'cancel': (_cancel, 'Cancel current brewing'),
+    'orders': (_orders, 'List dispatched orders which never finished or were interrupted'),
+}
+
+
+async def probe_status(coffee_machine, deadline):
+    """
+    Connect to a machine and wait for its status frame
+    :param deadline: event loop time by which the probe gives up
+    :return: True if a status frame was received
+    """
+    loop = asyncio.get_running_loop()
+    while not await coffee_machine.get_device_name():
+        if loop.time() + 1 >= deadline:
             return False
-        except Exception as error:
-            self.connected = False
-            _LOGGER.error('Unexpected error while sending command: %s', error, exc_info=True)
+        await asyncio.sleep(1)
+    await coffee_machine.debug()
+    while not coffee_machine._device_status:
+        if loop.time() >= deadline:
             return False
+        await asyncio.sleep(0.1)
+    return True
+
+
+async def fleet_status(macs, timeout=FLEET_TIMEOUT, host=None):
+    """
+    Probe several machines concurrently under one overall deadline
+    :param host: MachineHost to probe through; one is configured from the
+        environment, and closed afterwards, if None
+    :return: list of per-machine state dicts, in the order of macs
+    """
+    own_host = host is None
+    if own_host:
+        host = MachineHost.from_environment()
+    machines = [host.add(mac) for mac in macs]
+    deadline = asyncio.get_running_loop().time() + timeout
+    try:
+        results = await asyncio.gather(
+            *(asyncio.wait_for(probe_status(machine, deadline), timeout)
+              for machine in machines),
+            return_exceptions=True,
+        )
+    finally:
+        if own_host:
+            await host.close()
+
+    documents = []
+    for machine, result in zip(machines, results):
+        document = machine.as_dict()
+        if result is True:
+            document['error'] = None
+        elif isinstance(result, BaseException) and not isinstance(result, asyncio.TimeoutError):
+            document['error'] = str(result) or type(result).__name__
+        else:
+            # Ran out of time, either connecting or waiting for a notification
+            document['error'] = (
+                'no status received' if machine.connected else 'connection failed'
+            )
+        documents.append(document)
+    return documents
+
+
+def parse_fleet_args(args):
+    """
+    Parse 'status' fleet arguments: MAC addresses or --all, and --timeout
+    :return: (macs, timeout)
+    :raises ValueError: on malformed arguments
+    """
+    macs = []
+    timeout = FLEET_TIMEOUT
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '--all':
+            for mac in os.environ.get(FLEET_ENV, '').replace(',', ' ').split():
+                if mac not in macs:
+                    macs.append(mac)
+        elif arg == '--timeout':
+            if not args:
+                raise ValueError('--timeout needs a value in seconds')
+            try:
+                timeout = float(args.pop(0))
+            except ValueError as error:
+                raise ValueError('--timeout needs a value in seconds') from error
+        elif arg.startswith('-'):
+            raise ValueError(f'unknown option: {arg}')
+        elif arg not in macs:
+            macs.append(arg)
+    if not macs:
+        raise ValueError(f'no machines given (pass MAC addresses, or --all with {FLEET_ENV} set)')
+    return macs, timeout
+
 
+def parse_serve_args(args):
+    """
+    Parse 'serve' arguments: MAC addresses or --all, and --listen HOST:PORT
+    :return: (macs, address, state directory)
+    :raises ValueError: on malformed arguments
+    """
+    args = list(args)
+    address = os.environ.get(INTAKE_ENV) or INTAKE_ADDRESS
+    if '--listen' in args:
+        index = args.index('--listen')
+        if index + 1 >= len(args):
+            raise ValueError('--listen needs HOST:PORT')
+        address = args[index + 1]
+        del args[index:index + 2]
+    if '--timeout' in args:
+        raise ValueError('unknown option: --timeout')
+    _load_runtime()
+    order_intake.parse_address(address)
+    macs, _ = parse_fleet_args(args)
+    state_dir = os.path.expanduser(os.environ.get(STATE_DIR_ENV) or SERVE_STATE_DIR)
+    return macs, address, state_dir
 
-async def main():
-    """Main function to demonstrate usage"""
-    import sys
-    
-    if len(sys.argv) < 2:
-        print("Usage: python delonghi_controller.py <MAC_ADDRESS> [command] [option]")
-        print("Available commands: status, power, espresso, coffee, americano, long, doppio, hotwater, steam, cancel")
+
+async def serve_orders(macs, address, state_dir):
+    """Take orders for the machines over the local intake until cancelled"""
+    os.makedirs(state_dir, exist_ok=True)
+    host = MachineHost.from_environment(state_dir)
+    for mac in macs:
+        host.add(mac)
+    host.start()
+    intake = order_intake.OrderIntake(host, beverage_order, default_mac=macs[0])
+    try:
+        await intake.start(address)
+        await intake.serve_forever()
+    finally:
+        await intake.close()
+        await host.close()
+
+
+def print_help():
+    """Print CLI usage"""
+    print(USAGE)
+    print("Available commands:")
+    for command, (_, help_text) in COMMANDS.items():
+        print(f"  {command:<9} - {help_text}")
+    print("  batch     - Run commands from a file, or stdin if no file or '-' is given")
+    print("")
+    print("Fleet status: python delonghi_controller.py status <MAC_ADDRESS>... [--timeout SECONDS]")
+    print(f"              python delonghi_controller.py status --all   (machines from ${FLEET_ENV})")
+    print("Probes all machines concurrently and prints one JSON document.")
+    print("Set $" + ADAPTERS_ENV + " (e.g. hci0,hci1) to spread connections over several adapters.")
+    print("Set $" + TRACE_ENV + " to a file to write a Chrome trace-event timeline of the run.")
+    print("")
+    print("Order intake: python delonghi_controller.py serve <MAC_ADDRESS>... [--listen HOST:PORT]")
+    print("Accepts JSON-line orders over TCP (default " + INTAKE_ADDRESS
+          + ", or $" + INTAKE_ENV + ") and streams back")
+    print("queued, brewing, done and failed events. Orders go to the first machine unless")
+    print('they name a "mac". Orders are journaled in $' + STATE_DIR_ENV + ", by default")
+    print(SERVE_STATE_DIR + ".")
+    print("")
+    print("Beverage commands take optional parameters as their option, e.g.")
+    print("  espresso volume=60,aroma=4   (" + ", ".join(BEVERAGE_PARAMETER_NAMES) + ")")
+    print("Beverage commands accept --order-id ID. With $" + STATE_DIR_ENV + " set, each order")
+    print("is journaled and a repeated order ID is not brewed again.")
+    print("")
+    print("Batch input has one command per line ('espresso', 'power on') or one JSON")
+    print('object per line ({"command": "espresso"}); blank lines and lines starting')
+    print("with '#' are ignored. All commands run over a single connection.")
+
+
+def pop_order_id(args):
+    """
+    Split '--order-id ID' out of command arguments
+    :return: (remaining arguments, order ID or None)
+    :raises ValueError: if the flag has no value
+    """
+    args = list(args)
+    if '--order-id' not in args:
+        return args, None
+    index = args.index('--order-id')
+    if index + 1 >= len(args):
+        raise ValueError('--order-id needs a value')
+    order_id = args[index + 1]
+    del args[index:index + 2]
+    return args, order_id
+
+
+def parse_batch(lines):
+    """
+    Parse batch input into a list of (command, option, order ID) tuples
+    :raises ValueError: on malformed lines or unknown commands
+    """
+    steps = []
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('{'):
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as error:
+                raise ValueError(f"line {line_number}: invalid JSON: {error}") from error
+            command = entry.get('command')
+            option = entry.get('option')
+            order_id = entry.get('order_id')
+        else:
+            try:
+                parts, order_id = pop_order_id(line.split())
+            except ValueError as error:
+                raise ValueError(f"line {line_number}: {error}") from error
+            if not parts or len(parts) > 2:
+                raise ValueError(
+                    f"line {line_number}: expected '<command> [option] [--order-id ID]'"
+                )
+            command = parts[0]
+            option = parts[1] if len(parts) > 1 else None
+        try:
+            validate_step(command, option)
+        except (TypeError, ValueError) as error:
+            raise ValueError(f"line {line_number}: {error}") from error
+        steps.append((command, option, order_id))
+    return steps
+
+
+def _read_batch(source):
+    """Read batch lines from a file path, or stdin for None/'-'"""
+    if source in (None, '-'):
+        return sys.stdin.readlines()
+    with open(source, encoding='utf-8') as batch_file:
+        return batch_file.readlines()
+
+
+def cli(argv=None):
+    """
+    Parse and validate the command line, then run it.
+
+    Everything before the first BLE operation is synchronous, so help and
+    argument errors return without importing asyncio or starting a loop.
+    :param argv: arguments without the program name; sys.argv if None
+    :return: exit status
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv:
+        print(USAGE)
+        print("Available commands: " + ", ".join(COMMANDS) + ", batch")
         print("For power command, you can specify 'on' or 'off' as an option")
-        sys.exit(1)
-    
-    device_id = sys.argv[1]
-    command = sys.argv[2] if len(sys.argv) > 2 else "status"
-    option = sys.argv[3] if len(sys.argv) > 3 else None
-    
-    _LOGGER.info("Starting Delonghi controller with device ID: %s, command: %s, option: %s", 
-                device_id, command, option)
-    
+        return 1
+
+    if argv[0] in ('help', '-h', '--help'):
+        print_help()
+        return 0
+
+    if argv[0] == 'status':
+        try:
+            macs, timeout = parse_fleet_args(argv[1:])
+        except ValueError as error:
+            print(f"Invalid status arguments: {error}")
+            return 1
+        _LOGGER.info("Probing %d machines with a %s second deadline", len(macs), timeout)
+        _load_runtime()
+        machines = asyncio.run(fleet_status(macs, timeout))
+        print(json.dumps({'machines': machines}, indent=2))
+        return 1 if any(machine['error'] for machine in machines) else 0
+
+    if argv[0] == 'serve':
+        try:
+            macs, address, state_dir = parse_serve_args(argv[1:])
+        except ValueError as error:
+            print(f"Invalid serve arguments: {error}")
+            return 1
+        _load_runtime()
+        asyncio.run(serve_orders(macs, address, state_dir))
+        return 0
+
+    try:
+        args, order_id = pop_order_id(argv)
+    except ValueError as error:
+        print(f"Invalid arguments: {error}")
+        return 1
+    if not args:
+        print("Invalid arguments: no MAC address given")
+        print(USAGE)
+        return 1
+    device_id = args[0]
+    command = args[1] if len(args) > 1 else "status"
+    option = args[2] if len(args) > 2 else None
+
+    # Validate everything before any BLE work so argument errors return fast
+    if command == "help":
+        print_help()
+        return 0
+    if command == "batch":
+        try:
+            steps = parse_batch(_read_batch(option))
+        except (OSError, ValueError) as error:
+            print(f"Invalid batch input: {error}")
+            return 1
+    elif command in COMMANDS:
+        try:
+            validate_step(command, option)
+        except ValueError as error:
+            print(f"Invalid arguments: {error}")
+            return 1
+        steps = [(command, option, order_id)]
+    else:
+        print(f"Unknown command: {command}")
+        print("Available commands: " + ", ".join(COMMANDS) + ", batch")
+        print("Use 'help' command for more information")
+        return 1
+
+    _LOGGER.info("Starting Delonghi controller with device ID: %s, command: %s, option: %s",
+                 device_id, command, option)
+    _load_runtime()
+    asyncio.run(run_steps(device_id, steps))
+    return 0
+
+
+async def run_steps(device_id, steps):
+    """Run validated (command, option, order ID) steps over one connection"""
     # Create the coffee machine controller
-    coffee_machine = DelongiPrimadonna(device_id)
-    
+    host = MachineHost.from_environment()
+    coffee_machine = host.add(device_id)
+    host.start()
+
     try:
-        if command == "help":
-            print("Usage: python delonghi_controller.py <MAC_ADDRESS> [command] [option]")
-            print("Available commands:")
-            print("  status    - Get the current status of the coffee machine")
-            print("  power     - Toggle power (use 'on' or 'off' as option)")
-            print("  espresso  - Make an espresso")
-            print("  coffee    - Make a coffee")
-            print("  americano - Make an americano")
-            print("  long      - Make a long coffee")
-            print("  doppio    - Make a doppio")
-            print("  hotwater  - Dispense hot water")
-            print("  steam     - Activate steam")
-            print("  cancel    - Cancel current brewing")
-            return
-            
-        elif command == "status":
-            print(f"Attempting to connect to device: {device_id}")
-            
-            # Try to connect and get device name
-            connection_attempts = 0
-            max_attempts = 3
-            while connection_attempts < max_attempts:
-                connection_attempts += 1
-                try:
-                    print(f"Connection attempt {connection_attempts}/{max_attempts}...")
-                    name = await coffee_machine.get_device_name()
-                    if name:
-                        print(f"✓ Connected successfully to: {name}")
-                        break
-                    else:
-                        print("× Connection failed, retrying...")
-                        await asyncio.sleep(1)
-                except Exception as e:
-                    print(f"× Connection error: {e}")
-                    if connection_attempts < max_attempts:
-                        print("Retrying connection...")
-                        await asyncio.sleep(2)
-            
-            if not coffee_machine.connected:
-                print("Failed to connect to the coffee machine after multiple attempts.")
-                print("Please check:")
-                print("- The MAC address is correct")
-                print("- The coffee machine is powered on")
-                print("- Bluetooth is enabled on your device")
-                print("- You have the necessary permissions (try running with sudo on Linux)")
-                return
-            
-            # Request status update
-            print("Requesting device status...")
-            await coffee_machine.debug()
-            
-            # Wait for status updates to be received via notifications
-            print("Waiting for status updates (up to 60 seconds)...")
-            
-            # Wait up to 60 seconds for a response
-            max_wait_time = 60  # seconds
-            wait_interval = 2   # check every 2 seconds
-            waited_time = 0
-            
-            while waited_time < max_wait_time:
-                if coffee_machine._device_status:  # If we've received status data
-                    break
-                
-                # Print a waiting message every 10 seconds
-                if waited_time % 10 == 0 and waited_time > 0:
-                    print(f"Still waiting for response... ({waited_time} seconds elapsed)")
-                
-                await asyncio.sleep(wait_interval)
-                waited_time += wait_interval
-            
-            # Only display status information if we received data
-            if coffee_machine._device_status:
-                print("\n=== COFFEE MACHINE STATUS ===")
-                print(f"Device name: {coffee_machine.hostname}")
-                print(f"MAC address: {coffee_machine.mac}")
-                print(f"Model: {coffee_machine.model}")
-                print(f"Power state: {'ON' if coffee_machine.switches.is_on else 'OFF'}")
-                print(f"Machine status: {coffee_machine.status}")
-                print(f"Steam nozzle state: {coffee_machine.steam_nozzle}")
-                print(f"Currently brewing: {coffee_machine.cooking}")
-                print(f"Service value: {coffee_machine.service}")
-                print("\n=== SETTINGS ===")
-                print(f"Cup light: {'ON' if coffee_machine.switches.cup_light else 'OFF'}")
-                print(f"Energy save mode: {'ON' if coffee_machine.switches.energy_save else 'OFF'}")
-                print(f"Sound alerts: {'ON' if coffee_machine.switches.sounds else 'OFF'}")
-                print(f"\nRaw status data: {coffee_machine._device_status}")
-            else:
-                print("\nNo status data received after waiting 60 seconds.")
-                print("The machine may be powered off, in deep sleep mode, or not responding.")
-                print("Try sending a power command first: python delonghi_controller.py <MAC_ADDRESS> power")
-        
-        elif command == "power":
-            if option == "off":
-                # Power off is not directly supported, but we can cancel any brewing
-                await coffee_machine.beverage_cancel()
-                print("Cancelled brewing (note: machine may still be powered on)")
-            else:
-                await coffee_machine.power_on()
-                print("Power on command sent")
-                # Wait for status update
-                await asyncio.sleep(2)
-        
-        elif command == "espresso":
-            await coffee_machine.beverage_start(AvailableBeverage.ESPRESSO)
-            print("Making espresso")
-            coffee_machine.cooking = AvailableBeverage.ESPRESSO  # Update local state
-            # Wait for status update
-            await asyncio.sleep(2)
-        
-        elif command == "coffee":
-            await coffee_machine.beverage_start(AvailableBeverage.COFFEE)
-            print("Making coffee")
-            coffee_machine.cooking = AvailableBeverage.COFFEE  # Update local state
-            # Wait for status update
-            await asyncio.sleep(2)
-        
-        elif command == "americano":
-            await coffee_machine.beverage_start(AvailableBeverage.AMERICANO)
-            print("Making americano")
-            coffee_machine.cooking = AvailableBeverage.AMERICANO  # Update local state
-            # Wait for status update
-            await asyncio.sleep(2)
-        
-        elif command == "long":
-            await coffee_machine.beverage_start(AvailableBeverage.LONG)
-            print("Making long coffee")
-            coffee_machine.cooking = AvailableBeverage.LONG  # Update local state
-            # Wait for status update
-            await asyncio.sleep(2)
-        
-        elif command == "doppio":
-            await coffee_machine.beverage_start(AvailableBeverage.DOPIO)
-            print("Making doppio")
-            coffee_machine.cooking = AvailableBeverage.DOPIO  # Update local state
-            # Wait for status update
-            await asyncio.sleep(2)
-        
-        elif command == "hotwater":
-            await coffee_machine.beverage_start(AvailableBeverage.HOTWATER)
-            print("Dispensing hot water")
-            coffee_machine.cooking = AvailableBeverage.HOTWATER  # Update local state
-            # Wait for status update
-            await asyncio.sleep(2)
-        
-        elif command == "steam":
-            await coffee_machine.beverage_start(AvailableBeverage.STEAM)
-            print("Activating steam")
-            coffee_machine.cooking = AvailableBeverage.STEAM  # Update local state
-            # Wait for status update
-            await asyncio.sleep(2)
-        
-        elif command == "cancel":
-            await coffee_machine.beverage_cancel()
-            print("Cancelled brewing")
-            coffee_machine.cooking = AvailableBeverage.NONE  # Update local state
-            # Wait for status update
-            await asyncio.sleep(2)
-        
-        else:
-            print(f"Unknown command: {command}")
-            print("Available commands: status, power, espresso, coffee, americano, long, doppio, hotwater, steam, cancel")
-            print("Use 'help' command for more information")
-    
+        for step_command, step_option, step_order_id in steps:
+            if len(steps) > 1:
+                print(f"> {step_command}" + (f" {step_option}" if step_option else ""))
+            handler, _ = COMMANDS[step_command]
+            token = tracing.current_order.set(step_order_id)
+            try:
+                await handler(coffee_machine, step_option, step_order_id)
+            finally:
+                tracing.current_order.reset(token)
+
     except Exception as e:
         print(f"Error: {e}")
         import traceback
         traceback.print_exc()
         print("Use 'help' command for usage information")
-    
+
     finally:
         print("Disconnecting from coffee machine...")
-        await coffee_machine.disconnect()
+        await host.close()
         print("Disconnected")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
     # Set higher log level for debugging if needed
     if len(sys.argv) > 1 and sys.argv[1] == "--debug":
         logging.getLogger().setLevel(logging.DEBUG)
         logging.getLogger('bleak').setLevel(logging.DEBUG)
         sys.argv.pop(1)  # Remove the debug flag
-        
-    asyncio.run(main())
\ No newline at end of file
+
+    sys.exit(cli())
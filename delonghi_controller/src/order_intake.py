@@ -0,0 +1,294 @@
+"""Local order intake: orders are pushed in and their progress streamed back"""
+import asyncio
+import functools
+import json
+import logging
+
+try:
+    from . import order_journal
+except ImportError:  # run as a script rather than as part of the package
+    import order_journal
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds a brew may run before the machine is asked whether it finished
+BREW_TIMEOUT = 300
+# Seconds to wait for a machine to answer a status request, and between
+# requests while waiting for an unconfirmed brew to end
+STATUS_TIMEOUT = 30
+
+# Progress events, in the order an order goes through them
+QUEUED = 'queued'      # accepted and waiting for its machine
+BREWING = 'brewing'    # start command written to the machine
+DONE = 'done'          # machine finished the beverage
+FAILED = 'failed'      # rejected, not sent, or not brewed; see its 'state'
+
+# 'state' of a failed order which never reached a machine because it is
+# invalid; the other states are journal states, of which only 'failed' (the
+# start command was not sent) may be pushed again
+REJECTED = 'rejected'
+
+# Why an order which was not brewed to the end failed, by journal state
+_STATE_ERRORS = {
+    order_journal.CANCELLED: 'order was cancelled',
+    order_journal.INTERRUPTED: 'order was interrupted; push it again to brew it',
+    order_journal.UNCONFIRMED: 'the machine never confirmed the order finished',
+}
+_UNKNOWN_OUTCOME = 'order was started before a restart and its outcome is unknown'
+
+
+def parse_address(address):
+    """
+    Split 'HOST:PORT' into (host, port)
+    :raises ValueError: on a malformed address
+    """
+    host, separator, port = str(address).rpartition(':')
+    if not separator or not port.isdigit():
+        raise ValueError(f"expected HOST:PORT, got {address!r}")
+    return host or '127.0.0.1', int(port)
+
+
+class _Order:
+    """An accepted order and whoever follows its progress"""
+    __slots__ = ('order_id', 'mac', 'beverage', 'parameters', 'subscribers', 'last_event')
+
+    def __init__(self, order_id, mac, beverage, parameters):
+        self.order_id = order_id
+        self.mac = mac
+        self.beverage = beverage
+        self.parameters = parameters
+        self.subscribers = []
+        self.last_event = None
+
+
+class OrderIntake:
+    """
+    Queues orders per machine and reports their progress as events.
+
+    Orders arrive over a local TCP connection as one JSON object per line,
+    {"order_id": "0x12", "beverage": "espresso"}, optionally with "mac" (the
+    default machine otherwise) and "parameters". Each event goes back over the
+    same connection as one JSON line {"order_id": ..., "event": ...}: 'queued'
+    acknowledges the order, 'brewing' follows once the start command is
+    written, then 'done' once the machine is seen finishing it, or 'failed'
+    (with 'state' 'unconfirmed' if it never is). A machine brews its orders
+    one at a time, in arrival order; different machines brew concurrently,
+    and a machine which may still be busy takes no next order. An order
+    journaled by an earlier run is never brewed twice: it is reported done,
+    followed if the machine is still brewing it, or failed with its journal
+    'state' (e.g. 'cancelled').
+    """
+
+    def __init__(self, host, parse_order, default_mac=None, brew_timeout=BREW_TIMEOUT,
+                 status_timeout=STATUS_TIMEOUT):
+        """
+        :param host: MachineHost whose machines take orders
+        :param parse_order: callable (beverage, parameters) -> (beverage,
+            parameters) for dispatch(), raising ValueError for a bad order
+        :param default_mac: machine for orders which do not name one
+        :param brew_timeout: seconds to wait for a brew to be reported finished
+            before asking the machine
+        :param status_timeout: seconds to wait for a status answer
+        """
+        self.host = host
+        self.default_mac = default_mac
+        self.brew_timeout = brew_timeout
+        self.status_timeout = status_timeout
+        self._parse_order = parse_order
+        self._queues = {}    # mac -> asyncio.Queue of _Order
+        self._orders = {}    # order ID -> _Order, until done or failed
+        self._workers = []
+        self._server = None
+
+    async def start(self, address):
+        """
+        Listen for orders
+        :param address: 'HOST:PORT' to listen on
+        :return: the (host, port) listened on, useful with port 0
+        """
+        host, port = parse_address(address)
+        self._server = await asyncio.start_server(self._serve_client, host, port)
+        bound = self._server.sockets[0].getsockname()[:2]
+        _LOGGER.info('Accepting orders on %s:%s', *bound)
+        return bound
+
+    async def serve_forever(self):
+        """Serve until cancelled"""
+        await self._server.serve_forever()
+
+    async def close(self):
+        """Stop listening and stop brewing queued orders"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, request, send):
+        """
+        Accept an order; it is acknowledged, or rejected, before this returns
+        :param request: the order as a dict
+        :param send: callable receiving each event dict of the order
+        """
+        order_id = request.get('order_id') if isinstance(request, dict) else None
+        if order_id is None:
+            send({'order_id': None, 'event': FAILED, 'error': 'order_id is required'})
+            return
+        order_id = str(order_id)
+
+        order = self._orders.get(order_id)
+        if order is not None:
+            # A retried push follows the order already being handled
+            order.subscribers.append(send)
+            send(order.last_event)
+            return
+
+        mac = request.get('mac') or self.default_mac
+        try:
+            if mac not in self.host.machines:
+                raise ValueError(f'unknown machine: {mac}')
+            beverage, parameters = self._parse_order(
+                request.get('beverage'), request.get('parameters')
+            )
+        except (TypeError, ValueError) as error:
+            send({'order_id': order_id, 'event': FAILED, 'state': REJECTED,
+                  'error': str(error)})
+            return
+
+        order = _Order(order_id, mac, beverage, parameters)
+        order.subscribers.append(send)
+        self._orders[order_id] = order
+        self._queue(mac).put_nowait(order)
+        self._emit(order, QUEUED, mac=mac)
+
+    def _queue(self, mac):
+        """Return the machine's order queue, starting its worker on first use"""
+        queue = self._queues.get(mac)
+        if queue is None:
+            queue = self._queues[mac] = asyncio.Queue()
+            self._workers.append(asyncio.create_task(self._brew_orders(mac, queue)))
+        return queue
+
+    async def _brew_orders(self, mac, queue):
+        """Brew a machine's orders one after another"""
+        machine = self.host.machines[mac]
+        while True:
+            order = await queue.get()
+            try:
+                await self._brew(machine, order)
+            except Exception as error:
+                _LOGGER.error('Order %s failed: %s', order.order_id, error, exc_info=True)
+                fields = {'error': str(error) or type(error).__name__}
+                if self.host.journal is not None:
+                    # E.g. 'failed' if the device was not found; the journal
+                    # tells whether the order may have reached the machine
+                    fields['state'] = self.host.journal.state(order.order_id)
+                self._finish(order, FAILED, **fields)
+
+    async def _brew(self, machine, order):
+        """Dispatch one order and wait for the machine to finish it"""
+        journal = self.host.journal
+        # A duplicate of an order started earlier also comes back 'started'
+        earlier = journal.state(order.order_id) if journal is not None else None
+        state = await machine.dispatch(order.beverage, order.order_id, order.parameters)
+        if state == order_journal.STARTED and earlier not in order_journal.UNSETTLED:
+            self._emit(order, BREWING)
+            await self._wait_finished(machine, order)
+        elif state == order_journal.DONE:
+            # Finished in an earlier run; the journal remembers it
+            self._finish(order, DONE, confirmed=True)
+        elif state == order_journal.FAILED:
+            self._finish(order, FAILED, state=state, error='start command could not be sent')
+        elif (machine.in_flight is not None
+              and machine.in_flight.get('order_id') == order.order_id):
+            # Started before a restart and still brewing; follow it again
+            self._emit(order, BREWING, state=state)
+            await self._wait_finished(machine, order)
+        else:
+            # Started before a restart and not brewing now, cancelled or
+            # unconfirmed. It is not brewed twice; its state tells the client why
+            self._finish(order, FAILED, state=state,
+                         error=_STATE_ERRORS.get(state, _UNKNOWN_OUTCOME))
+
+    async def _wait_finished(self, machine, order):
+        """
+        Report a brewing order done once the machine is seen finishing it.
+        Otherwise it fails as unconfirmed, and the machine's next order waits
+        until the machine reports it is idle
+        """
+        in_flight = machine.in_flight
+        finished = await machine.wait_finished(self.brew_timeout)
+        answered = True
+        while not finished:
+            _LOGGER.warning('Order %s not reported finished within %s seconds, asking %s',
+                            order.order_id, self.brew_timeout, machine.mac)
+            answered = await machine.request_status(self.status_timeout)
+            if machine.in_flight is not in_flight:
+                finished = True  # the answer showed the brew ending
+            elif answered and machine.brewing:
+                finished = await machine.wait_finished(self.brew_timeout)
+            else:
+                break
+
+        if finished:
+            journal = self.host.journal
+            state = journal.state(order.order_id) if journal is not None else order_journal.DONE
+            if state == order_journal.DONE:
+                self._finish(order, DONE, confirmed=True)
+            else:
+                # Settled otherwise, e.g. interrupted by reconcile() or cancelled
+                self._finish(order, FAILED, state=state,
+                             error=_STATE_ERRORS.get(state, _UNKNOWN_OUTCOME))
+            return
+
+        machine.settle_in_flight(order_journal.UNCONFIRMED)
+        self._finish(order, FAILED, state=order_journal.UNCONFIRMED,
+                     error=_STATE_ERRORS[order_journal.UNCONFIRMED])
+        while not answered or machine.brewing:
+            # Never start the next order on a machine which may still be busy
+            await asyncio.sleep(self.status_timeout)
+            answered = await machine.request_status(self.status_timeout)
+
+    def _emit(self, order, event, **fields):
+        """Send an event to everyone following the order"""
+        message = {'order_id': order.order_id, 'event': event, **fields}
+        order.last_event = message
+        for send in order.subscribers:
+            send(message)
+
+    def _finish(self, order, event, **fields):
+        """Send the final event of an order and forget it"""
+        self._emit(order, event, **fields)
+        self._orders.pop(order.order_id, None)
+
+    async def _serve_client(self, reader, writer):
+        """Read orders from one connection and stream their events back"""
+        send = functools.partial(self._write, writer)
+        try:
+            while line := await reader.readline():
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError as error:
+                    send({'order_id': None, 'event': FAILED, 'error': f'invalid JSON: {error}'})
+                    continue
+                self.submit(request, send)
+        except (ConnectionError, ValueError) as error:
+            # ValueError: a line longer than the stream limit
+            _LOGGER.warning('Dropping intake connection: %s', error)
+        finally:
+            # Orders keep brewing; only their events to this connection stop
+            for order in self._orders.values():
+                if send in order.subscribers:
+                    order.subscribers.remove(send)
+            writer.close()
+
+    @staticmethod
+    def _write(writer, message):
+        """Write one event line unless the connection is gone"""
+        if not writer.is_closing():
+            writer.write(json.dumps(message).encode() + b'\n')
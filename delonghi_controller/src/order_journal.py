@@ -0,0 +1,129 @@
+"""Append-only journal of beverage dispatches keyed by order ID"""
+import logging
+import sqlite3
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# Order states, in the order they are journaled
+DISPATCHED = 'dispatched'  # about to write the start command
+STARTED = 'started'        # start command written to the machine
+DONE = 'done'              # machine finished the beverage
+FAILED = 'failed'          # start command could not be written
+CANCELLED = 'cancelled'    # beverage was cancelled on request
+# In flight across a restart and no longer running afterwards; whether the
+# cup was finished is unknown, so the order may be dispatched again
+INTERRUPTED = 'interrupted'
+# Never seen finishing, nor the machine seen brewing it; the cup may exist,
+# so, unlike an interrupted order, it is not dispatched again
+UNCONFIRMED = 'unconfirmed'
+# States of an order which was dispatched but has not finished or failed
+UNSETTLED = (DISPATCHED, STARTED)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dispatches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id TEXT NOT NULL,
+    mac TEXT NOT NULL,
+    command TEXT NOT NULL,
+    state TEXT NOT NULL,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dispatches_order_id ON dispatches (order_id, id);
+'''
+
+
+class OrderJournal:
+    """
+    SQLite journal, in WAL mode, with one row per order state change.
+
+    An order may be dispatched once; it can only be dispatched again after it
+    failed or was interrupted, so a retried request never brews a second cup.
+    """
+
+    def __init__(self, path):
+        """Open or create the journal at path"""
+        self.path = path
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # WAL with synchronous=NORMAL survives process crashes; only a power
+        # loss can drop the most recent transactions
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        """Close the journal"""
+        self._db.close()
+
+    def state(self, order_id):
+        """Return the latest state of an order, or None if never dispatched"""
+        row = self._db.execute(
+            'SELECT state FROM dispatches WHERE order_id = ? ORDER BY id DESC LIMIT 1',
+            (order_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def begin(self, order_id, mac, command):
+        """
+        Journal a dispatch unless the order was already dispatched
+        :return: True if the caller should go ahead, False for a duplicate
+        """
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            state = self.state(order_id)
+            if state is not None and state not in (FAILED, INTERRUPTED):
+                self._db.execute('ROLLBACK')
+                _LOGGER.info('Dropping duplicate dispatch of order %s (%s)', order_id, state)
+                return False
+            self._append(order_id, mac, command, DISPATCHED)
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        return True
+
+    def record(self, order_id, state):
+        """Journal a state change of a dispatched order"""
+        row = self._db.execute(
+            'SELECT mac, command FROM dispatches WHERE order_id = ? ORDER BY id DESC LIMIT 1',
+            (order_id,)
+        ).fetchone()
+        if row is None:
+            _LOGGER.warning('Order %s was never dispatched, not recording %s', order_id, state)
+            return
+        self._append(order_id, row[0], row[1], state)
+
+    def in_flight(self, mac=None):
+        """
+        Return orders which were dispatched but never finished or failed,
+        oldest first, optionally only those for one machine
+        """
+        return self._latest(UNSETTLED, mac)
+
+    def interrupted(self, mac=None):
+        """Return orders interrupted by a restart, oldest first"""
+        return self._latest((INTERRUPTED,), mac)
+
+    def _latest(self, states, mac):
+        """Return orders whose latest state is one of states"""
+        query = f'''
+            SELECT order_id, mac, command, state, at FROM dispatches
+            WHERE id IN (SELECT MAX(id) FROM dispatches GROUP BY order_id)
+              AND state IN ({', '.join('?' * len(states))})
+        '''
+        params = list(states)
+        if mac is not None:
+            query += ' AND mac = ?'
+            params.append(mac)
+        query += ' ORDER BY id'
+        return [
+            {'order_id': order_id, 'mac': mac, 'command': command, 'state': state, 'at': at}
+            for order_id, mac, command, state, at in self._db.execute(query, params)
+        ]
+
+    def _append(self, order_id, mac, command, state):
+        """Append one journal row"""
+        self._db.execute(
+            'INSERT INTO dispatches (order_id, mac, command, state, at) VALUES (?, ?, ?, ?, ?)',
+            (order_id, mac, command, state, time.time())
+        )
@@ -0,0 +1,117 @@
+"""Span tracing exported as Chrome trace-event JSON, viewable in Perfetto"""
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import time
+
+# Order (or request) the current task works on; attached to its spans
+current_order = contextvars.ContextVar('current_order', default=None)
+
+_NULL_SPAN = contextlib.nullcontext()
+
+# Events kept in memory; older ones are dropped so a long-running server
+# stays bounded. Each is a small dict, so this is some tens of megabytes
+MAX_EVENTS = 100_000
+
+
+class Tracer:
+    """
+    Collects the latest max_events spans and instant events in memory until
+    export(), which may be called repeatedly to keep a file up to date.
+
+    Each lane, typically a machine's MAC address, becomes one named track.
+    A disabled tracer returns a shared no-op context manager from span(), so
+    instrumented code pays for one method call; guard anything costly to
+    build with `if tracer.enabled`.
+    """
+
+    def __init__(self, enabled=True, max_events=MAX_EVENTS):
+        self.enabled = enabled
+        self._events = collections.deque(maxlen=max_events)
+        self._lanes = {}
+        self._lane_names = []  # metadata events, kept apart so never dropped
+        self._recorded = 0
+        self._exported = 0
+        self._pid = os.getpid()
+        self._origin = time.perf_counter_ns()
+
+    def span(self, name, lane='main', **args):
+        """Return a context manager timing the enclosed block"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, lane, args)
+
+    def instant(self, name, lane='main', **args):
+        """Record a point in time, e.g. a notification arriving"""
+        if not self.enabled:
+            return
+        self._record({
+            'name': name, 'ph': 'i', 's': 't', 'ts': self._now(),
+            'pid': self._pid, 'tid': self._lane(lane), 'args': self._args(args),
+        })
+
+    @property
+    def changed(self):
+        """Whether events were recorded since the last export()"""
+        return self._recorded != self._exported
+
+    def events(self):
+        """Return the lane names and the recorded trace events still kept"""
+        return self._lane_names + list(self._events)
+
+    def export(self, path):
+        """Write the trace as Chrome trace-event JSON, replacing path atomically"""
+        recorded = self._recorded
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as trace_file:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, trace_file)
+        os.replace(temp_path, path)
+        self._exported = recorded
+
+    @contextlib.contextmanager
+    def _span(self, name, lane, args):
+        start = self._now()
+        try:
+            yield
+        except BaseException as error:
+            args['error'] = repr(error)
+            raise
+        finally:
+            self._record({
+                'name': name, 'ph': 'X', 'ts': start, 'dur': self._now() - start,
+                'pid': self._pid, 'tid': self._lane(lane), 'args': self._args(args),
+            })
+
+    def _record(self, event):
+        self._events.append(event)
+        self._recorded += 1
+
+    def _now(self):
+        """Microseconds since the tracer was created"""
+        return (time.perf_counter_ns() - self._origin) / 1000
+
+    def _lane(self, lane):
+        """Return the thread ID for a lane, naming it on first use"""
+        tid = self._lanes.get(lane)
+        if tid is None:
+            tid = self._lanes[lane] = len(self._lanes) + 1
+            self._lane_names.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid,
+                'args': {'name': str(lane)},
+            })
+        return tid
+
+    @staticmethod
+    def _args(args):
+        """Attach the current order to event arguments unless given"""
+        if 'order_id' not in args:
+            order_id = current_order.get()
+            if order_id is not None:
+                args['order_id'] = order_id
+        return args
+
+
+# Shared tracer for code which is not being traced
+DISABLED = Tracer(enabled=False)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Unit tests for multi-adapter connection balancing"""
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from src.adapters import AdapterPool
+from src.delonghi_controller import DelongiPrimadonna
+
+
+class TestAdapterPool(unittest.TestCase):
+    """Test cases for AdapterPool"""
+
+    def setUp(self):
+        """Set up a pool of two adapters"""
+        self.pool = AdapterPool(['hci0', 'hci1'])
+
+    def test_fewest_links(self):
+        """Test machines are spread over the adapters"""
+        first = self.pool.choose('AA')
+        self.pool.connected('AA', first)
+        second = self.pool.choose('BB')
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.pool.choose('AA'), first)
+
+    def test_best_rssi(self):
+        """Test equally loaded adapters are ranked by RSSI"""
+        self.pool.record_rssi('AA', 'hci0', -90)
+        self.pool.record_rssi('AA', 'hci1', -60)
+        self.assertEqual(self.pool.choose('AA'), 'hci1')
+
+    def test_move_after_failures(self):
+        """Test a machine moves after repeated failures, and back once all failed"""
+        adapter = self.pool.choose('AA')
+        for _ in range(3):
+            self.pool.failed('AA', adapter)
+        other = self.pool.choose('AA')
+        self.assertNotEqual(other, adapter)
+        for _ in range(3):
+            self.pool.failed('AA', other)
+        self.assertIn(self.pool.choose('AA'), ['hci0', 'hci1'])
+
+    def test_success_clears_failures(self):
+        """Test only a command getting through, not a connect, clears failures"""
+        adapter = self.pool.choose('AA')
+        for _ in range(2):
+            self.pool.failed('AA', adapter)
+            self.pool.connected('AA', adapter)
+        self.pool.failed('AA', adapter)
+        self.assertNotEqual(self.pool.choose('AA'), adapter)
+
+        other = self.pool.choose('AA')
+        for _ in range(2):
+            self.pool.failed('AA', other)
+        self.pool.succeeded('AA', other)
+        self.pool.failed('AA', other)
+        self.assertEqual(self.pool.choose('AA'), other)
+
+    def test_links(self):
+        """Test link counting survives repeated disconnects"""
+        self.pool.connected('AA', 'hci0')
+        self.pool.disconnected('AA', 'hci0')
+        self.pool.disconnected('AA', 'hci0')
+        self.assertEqual(self.pool.links(), {'hci0': 0, 'hci1': 0})
+
+    def test_requires_adapters(self):
+        """Test an empty pool is rejected"""
+        with self.assertRaises(ValueError):
+            AdapterPool([])
+
+
+class TestControllerAdapters(unittest.TestCase):
+    """Test cases for connecting through an AdapterPool"""
+
+    def setUp(self):
+        """Set up BLE mocks"""
+        self.mock_client_patcher = patch('src.delonghi_controller.BleakClient')
+        self.mock_client = self.mock_client_patcher.start()
+        self.mock_scanner_patcher = patch('src.delonghi_controller.BleakScanner')
+        self.mock_scanner = self.mock_scanner_patcher.start()
+        self.mock_scanner.find_device_by_filter = AsyncMock(return_value=MagicMock())
+
+        self.mock_client_instance = MagicMock()
+        self.mock_client_instance.is_connected = True
+        self.mock_client_instance.connect = AsyncMock()
+        self.mock_client_instance.disconnect = AsyncMock()
+        self.mock_client_instance.start_notify = AsyncMock()
+        self.mock_client.return_value = self.mock_client_instance
+
+        self.pool = AdapterPool(['hci0', 'hci1'])
+
+    def tearDown(self):
+        """Tear down BLE mocks"""
+        self.mock_client_patcher.stop()
+        self.mock_scanner_patcher.stop()
+
+    def test_connect_balances(self):
+        """Test two machines connect through different adapters"""
+        first = DelongiPrimadonna('AA', adapter_pool=self.pool)
+        second = DelongiPrimadonna('BB', adapter_pool=self.pool)
+        asyncio.run(first._connect())
+        asyncio.run(second._connect())
+
+        adapters = [call.kwargs['bluez']['adapter'] for call in self.mock_client.call_args_list]
+        self.assertEqual(sorted(adapters), ['hci0', 'hci1'])
+        self.assertEqual(self.pool.links(), {'hci0': 1, 'hci1': 1})
+
+        asyncio.run(first.disconnect())
+        self.assertEqual(sum(self.pool.links().values()), 1)
+
+    def test_connect_failure_moves_machine(self):
+        """Test repeated connection failures move the machine to the other adapter"""
+        self.mock_client_instance.is_connected = False
+        self.mock_client_instance.connect = AsyncMock(side_effect=OSError('link lost'))
+        coffee_machine = DelongiPrimadonna('AA', adapter_pool=self.pool)
+        for _ in range(3):
+            with self.assertRaises(OSError):
+                asyncio.run(coffee_machine._connect())
+        first = self.mock_client.call_args_list[0].kwargs['bluez']['adapter']
+        self.assertNotEqual(self.pool.choose('AA'), first)
+
+    def test_write_failure_moves_machine(self):
+        """Test repeated write failures drop the client and move the machine"""
+        self.mock_client_instance.write_gatt_char = AsyncMock(side_effect=OSError('link lost'))
+        coffee_machine = DelongiPrimadonna('AA', adapter_pool=self.pool)
+        for _ in range(4):
+            self.assertFalse(asyncio.run(coffee_machine.send_command([0x0d, 0x00])))
+        self.assertEqual(self.mock_client_instance.disconnect.await_count, 4)
+        adapters = [call.kwargs['bluez']['adapter'] for call in self.mock_client.call_args_list]
+        self.assertEqual(len(adapters), 4)
+        self.assertNotEqual(adapters[3], adapters[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 """Unit tests for Delonghi Primadonna Controller"""
 import asyncio
+import contextlib
+import io
+import os
+import tempfile
 import unittest
 from unittest.mock import AsyncMock, MagicMock, patch
 
@@ -10,7 +14,21 @@ from src.delonghi_controller import (
     CONTROLL_CHARACTERISTIC,
     NAME_CHARACTERISTIC,
     DEBUG,
-    BYTES_POWER
+    BYTES_POWER,
+    DEVICE_READY,
+    ESPRESSO_ON,
+    BEVERAGE_COMMANDS,
+    BEVERAGE_IDS,
+    MachineHost,
+    beverage_order,
+    beverage_start_frame,
+    cli,
+    sign_request,
+    fleet_status,
+    parse_batch,
+    parse_beverage_parameters,
+    parse_fleet_args,
+    parse_serve_args,
 )
 
 
@@ -80,7 +98,7 @@ class TestDelongiPrimadonna(unittest.TestCase):
         
         # Verify start_notify was called with correct characteristic
         self.mock_client_instance.start_notify.assert_called_once_with(
-            CONTROLL_CHARACTERISTIC, self.coffee_machine._handle_data
+            CONTROLL_CHARACTERISTIC, self.coffee_machine._on_notification
         )
         
         # Verify connected state
@@ -112,21 +130,17 @@ class TestDelongiPrimadonna(unittest.TestCase):
         self.assertEqual(result, self.device_name)
         self.assertEqual(self.coffee_machine.hostname, self.device_name)
 
-    def test_power_on(self):
+    @patch.object(DelongiPrimadonna, 'send_command', new_callable=AsyncMock)
+    def test_power_on(self, send_command):
         """Test power on command"""
-        # Mock send_command
-        self.coffee_machine.send_command = AsyncMock()
-        
         asyncio.run(self.async_test(self.coffee_machine.power_on()))
         
         # Verify send_command was called with BYTES_POWER
-        self.coffee_machine.send_command.assert_called_once_with(BYTES_POWER)
+        send_command.assert_called_once_with(BYTES_POWER)
 
-    def test_beverage_start(self):
+    @patch.object(DelongiPrimadonna, 'send_command', new_callable=AsyncMock)
+    def test_beverage_start(self, send_command):
         """Test starting a beverage"""
-        # Mock send_command
-        self.coffee_machine.send_command = AsyncMock()
-        
         # Test starting espresso
         asyncio.run(self.async_test(self.coffee_machine.beverage_start(AvailableBeverage.ESPRESSO)))
         
@@ -134,13 +148,11 @@ class TestDelongiPrimadonna(unittest.TestCase):
         self.assertEqual(self.coffee_machine.cooking, AvailableBeverage.ESPRESSO)
         
         # Verify send_command was called with correct command
-        self.coffee_machine.send_command.assert_called_once()
+        send_command.assert_called_once()
 
-    def test_beverage_cancel(self):
+    @patch.object(DelongiPrimadonna, 'send_command', new_callable=AsyncMock)
+    def test_beverage_cancel(self, send_command):
         """Test canceling a beverage"""
-        # Mock send_command
-        self.coffee_machine.send_command = AsyncMock()
-        
         # Set cooking state
         self.coffee_machine.cooking = AvailableBeverage.ESPRESSO
         
@@ -151,7 +163,7 @@ class TestDelongiPrimadonna(unittest.TestCase):
         self.assertEqual(self.coffee_machine.cooking, AvailableBeverage.NONE)
         
         # Verify send_command was called
-        self.coffee_machine.send_command.assert_called_once()
+        send_command.assert_called_once()
 
     def test_handle_data(self):
         """Test handling data from device"""
@@ -196,5 +208,322 @@ class TestDelongiPrimadonna(unittest.TestCase):
         self.assertEqual(command[9], 4)  
 
 
+class TestBeverageFrames(unittest.TestCase):
+    """Test cases for the beverage start frame builder"""
+
+    def test_defaults_match_frame_table(self):
+        """Test default frames are the hand-copied start frames"""
+        for beverage in BEVERAGE_IDS:
+            self.assertEqual(
+                beverage_start_frame(beverage), bytes(BEVERAGE_COMMANDS[beverage].on), beverage
+            )
+
+    def test_parameters(self):
+        """Test overrides are encoded in place and the frame is re-signed"""
+        frame = beverage_start_frame(AvailableBeverage.ESPRESSO, volume=60, aroma=5)
+        expected = list(ESPRESSO_ON)
+        expected[8] = 60
+        expected[10] = 5
+        self.assertEqual(frame, bytes(sign_request(expected)))
+
+    def test_cached(self):
+        """Test repeated menu items are served from the cache"""
+        beverage_start_frame.cache_clear()
+        first = beverage_start_frame(AvailableBeverage.COFFEE, volume=100)
+        second = beverage_start_frame(AvailableBeverage.COFFEE, volume=100)
+        self.assertIs(first, second)
+        self.assertEqual(beverage_start_frame.cache_info().hits, 1)
+
+    def test_invalid(self):
+        """Test unknown parameters and out of range values are rejected"""
+        with self.assertRaises(ValueError):
+            beverage_start_frame(AvailableBeverage.ESPRESSO, sugar=1)
+        with self.assertRaises(ValueError):
+            beverage_start_frame(AvailableBeverage.ESPRESSO, aroma=256)
+        with self.assertRaises(ValueError):
+            beverage_start_frame(AvailableBeverage.NONE)
+
+    def test_parameters_of_other_beverages(self):
+        """Test a beverage only takes the parameters its frame carries"""
+        with self.assertRaises(ValueError):
+            beverage_start_frame(AvailableBeverage.HOTWATER, volume=60)
+        with self.assertRaises(ValueError):
+            beverage_start_frame(AvailableBeverage.STEAM, aroma=3)
+        with self.assertRaises(ValueError):
+            beverage_start_frame(AvailableBeverage.DOPIO, aroma=3)
+        beverage_start_frame(AvailableBeverage.HOTWATER, water=200)
+
+    def test_bool_values(self):
+        """Test booleans, e.g. from JSON, are not taken as numbers"""
+        beverage_start_frame(AvailableBeverage.ESPRESSO, volume=1)
+        with self.assertRaises(ValueError):
+            beverage_start_frame(AvailableBeverage.ESPRESSO, volume=True)
+        with self.assertRaises(ValueError):
+            beverage_order('espresso', {'volume': True})
+
+    def test_parse_beverage_parameters(self):
+        """Test CLI and JSON beverage options"""
+        self.assertEqual(parse_beverage_parameters('volume=60, aroma=0x4'), {'volume': 60, 'aroma': 4})
+        self.assertEqual(parse_beverage_parameters({'milk': 500}), {'milk': 500})
+        self.assertEqual(parse_beverage_parameters(None), {})
+        with self.assertRaises(ValueError):
+            parse_beverage_parameters('volume')
+        with self.assertRaises(ValueError):
+            parse_beverage_parameters('sugar=1')
+
+
+class TestMachineHost(unittest.TestCase):
+    """Test cases for hosting several machines in one event loop"""
+
+    def test_machines_are_independent(self):
+        """Test each machine keeps its own state while sharing the host's services"""
+        host = MachineHost()
+        first = host.add('AA')
+        second = host.add('BB')
+        self.assertIs(host.add('AA'), first)
+
+        first._on_notification(None, bytearray([0, 0, 0, 0, 1, 3, 0, 0, 0, 1]))
+        self.assertEqual(first.status, 'COOKING')
+        self.assertTrue(first.switches.is_on)
+        self.assertEqual(second.status, 'UNKNOWN')
+        self.assertFalse(second.switches.is_on)
+
+    def test_state_dir(self):
+        """Test machines get their own snapshot file and share the journal"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with patch.dict(os.environ, {'DELONGHI_STATE_DIR': temp_dir}):
+                host = MachineHost.from_environment()
+            host.add('00:11:22:33:44:55').hostname = 'D1234'
+            host.add('66:77:88:99:AA:BB')
+            asyncio.run(host.close())
+            self.assertEqual(
+                sorted(os.listdir(temp_dir)),
+                ['001122334455.json', '66778899aabb.json', 'journal.sqlite3']
+            )
+
+    def test_slots(self):
+        """Test per-machine state objects do not carry a dict"""
+        machine = DelongiPrimadonna('AA')
+        self.assertFalse(hasattr(machine, '__dict__'))
+        self.assertFalse(hasattr(machine.switches, '__dict__'))
+        with self.assertRaises(AttributeError):
+            machine.send_command = AsyncMock()
+        with self.assertRaises(AttributeError):
+            machine.switches.colour = 'red'
+
+
+class TestNotificationDecoder(unittest.TestCase):
+    """Test cases for decoding truncated and odd notification frames"""
+
+    def test_truncated_frames(self):
+        """Test every prefix of a status frame decodes without an error"""
+        machine = DelongiPrimadonna('AA')
+        for length in range(len(DEVICE_READY) + 1):
+            frame = bytearray(DEVICE_READY[:length])
+            machine._on_notification(None, frame)
+            self.assertEqual(machine._device_status, frame)
+            # Only frames long enough to carry a status byte change the status
+            self.assertEqual(machine.status, 'OK' if length > 5 else 'UNKNOWN')
+
+    def test_unknown_codes(self):
+        """Test unknown status and nozzle codes keep the state usable"""
+        machine = DelongiPrimadonna('AA')
+        machine._on_notification(None, bytearray([0xff] * 10))
+        self.assertEqual(machine.status, 'OK')
+        self.assertEqual(machine.steam_nozzle, 0xff)
+        self.assertTrue(machine.switches.is_on)
+
+
+class TestCli(unittest.TestCase):
+    """Test cases for the synchronous command-line entry point"""
+
+    def run_cli(self, *args):
+        """Run the CLI and return its exit status and output"""
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            status = cli(list(args))
+        return status, output.getvalue()
+
+    def test_help(self):
+        """Test help succeeds without touching a machine"""
+        status, output = self.run_cli('help')
+        self.assertEqual(status, 0)
+        self.assertIn('Available commands', output)
+
+    def test_argument_errors(self):
+        """Test argument errors fail before any BLE work"""
+        self.assertEqual(self.run_cli()[0], 1)
+        self.assertEqual(self.run_cli('--order-id', 'X')[0], 1)
+        self.assertEqual(self.run_cli('AA', 'unknown')[0], 1)
+        self.assertEqual(self.run_cli('AA', 'espresso', 'colour=1')[0], 1)
+        self.assertEqual(self.run_cli('status')[0], 1)
+
+    def test_serve_journals(self):
+        """Test serve always has a state directory for its journal"""
+        with patch.dict(os.environ, {'DELONGHI_STATE_DIR': '', 'DELONGHI_INTAKE': ''}):
+            _, address, state_dir = parse_serve_args(['AA'])
+        self.assertEqual(address, '127.0.0.1:8765')
+        self.assertEqual(state_dir, os.path.expanduser('~/.local/state/delonghi'))
+        with patch.dict(os.environ, {'DELONGHI_STATE_DIR': '/tmp/delonghi'}):
+            self.assertEqual(parse_serve_args(['AA'])[2], '/tmp/delonghi')
+
+
+class TestParseBatch(unittest.TestCase):
+    """Test cases for batch input parsing"""
+
+    def test_plain_and_json_lines(self):
+        """Test plain and JSON lines parse to (command, option) pairs"""
+        lines = [
+            '# warm up\n',
+            'power on\n',
+            '\n',
+            '{"command": "espresso"}\n',
+            '{"command": "power", "option": "off"}\n',
+        ]
+        self.assertEqual(
+            parse_batch(lines),
+            [('power', 'on', None), ('espresso', None, None), ('power', 'off', None)]
+        )
+
+    def test_order_ids(self):
+        """Test order IDs are taken from plain and JSON lines"""
+        lines = [
+            'espresso --order-id 0xabc\n',
+            '{"command": "coffee", "order_id": "0xdef"}\n',
+        ]
+        self.assertEqual(
+            parse_batch(lines),
+            [('espresso', None, '0xabc'), ('coffee', None, '0xdef')]
+        )
+        with self.assertRaises(ValueError):
+            parse_batch(['espresso --order-id'])
+
+    def test_beverage_parameters(self):
+        """Test beverage parameters are validated while parsing"""
+        self.assertEqual(
+            parse_batch(['{"command": "espresso", "option": {"volume": 60}}']),
+            [('espresso', {'volume': 60}, None)]
+        )
+        with self.assertRaisesRegex(ValueError, 'line 1'):
+            parse_batch(['espresso volume=99999'])
+
+    def test_unknown_command(self):
+        """Test unknown commands are rejected with their line number"""
+        with self.assertRaisesRegex(ValueError, 'line 2'):
+            parse_batch(['espresso', 'frappuccino'])
+
+    def test_invalid_json(self):
+        """Test malformed JSON lines are rejected"""
+        with self.assertRaises(ValueError):
+            parse_batch(['{"command": '])
+
+
+class TestFleetStatus(unittest.TestCase):
+    """Test cases for the concurrent fleet status probe"""
+
+    def test_parse_fleet_args(self):
+        """Test MAC lists, --all and --timeout parsing"""
+        with patch.dict(os.environ, {'DELONGHI_MACHINES': 'AA:AA, BB:BB'}):
+            self.assertEqual(
+                parse_fleet_args(['CC:CC', '--all', 'AA:AA', '--timeout', '5']),
+                (['CC:CC', 'AA:AA', 'BB:BB'], 5.0)
+            )
+        with self.assertRaises(ValueError):
+            parse_fleet_args([])
+        with self.assertRaises(ValueError):
+            parse_fleet_args(['AA:AA', '--timeout'])
+
+    def test_fleet_status(self):
+        """Test machines are probed concurrently and reported individually"""
+        async def get_device_name(machine):
+            if machine.mac == 'OFFLINE':
+                return None
+            machine.connected = True
+            machine.hostname = f'name-{machine.mac}'
+            return machine.hostname
+
+        async def debug(machine):
+            if machine.mac != 'SILENT':
+                await machine._handle_data(None, bytearray([0, 0, 0, 0, 1, 3, 0, 2, 0, 1]))
+
+        with patch.object(DelongiPrimadonna, 'get_device_name', get_device_name), \
+                patch.object(DelongiPrimadonna, 'debug', debug), \
+                patch.object(DelongiPrimadonna, 'disconnect', AsyncMock()):
+            machines = asyncio.run(fleet_status(['READY', 'OFFLINE', 'SILENT'], timeout=0.3))
+
+        ready, offline, silent = machines
+        self.assertIsNone(ready['error'])
+        self.assertTrue(ready['switches']['is_on'])
+        self.assertEqual(ready['status'], 'COOKING')
+        self.assertEqual(ready['steam_nozzle'], 'STEAM')
+        self.assertEqual(ready['service'], 2)
+        self.assertEqual(ready['raw'], '00 00 00 00 01 03 00 02 00 01')
+        self.assertEqual(offline['error'], 'connection failed')
+        self.assertEqual(silent['error'], 'no status received')
+        self.assertIsNone(silent['raw'])
+
+
+class TestSnapshot(unittest.TestCase):
+    """Test cases for warm-restart state snapshots"""
+
+    def setUp(self):
+        """Set up a snapshot file in a temporary directory"""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, 'machine.json')
+        self.mac_address = "00:11:22:33:44:55"
+
+    def tearDown(self):
+        """Remove the temporary directory"""
+        self.temp_dir.cleanup()
+
+    def test_defaults_are_stale(self):
+        """Test a fresh controller does not claim the machine is OK"""
+        coffee_machine = DelongiPrimadonna(self.mac_address, snapshot_path=self.path)
+        self.assertEqual(coffee_machine.status, 'UNKNOWN')
+        self.assertTrue(coffee_machine.stale)
+
+    @patch.object(DelongiPrimadonna, 'send_command', new_callable=AsyncMock)
+    def test_round_trip(self, send_command):
+        """Test state and the in-flight command survive a restart as stale state"""
+        coffee_machine = DelongiPrimadonna(self.mac_address, snapshot_path=self.path)
+        asyncio.run(coffee_machine._handle_data(None, bytearray([0, 0, 0, 0, 1, 3, 0, 2, 0, 1])))
+        coffee_machine.hostname = 'D1234'
+        asyncio.run(coffee_machine.beverage_start(AvailableBeverage.ESPRESSO))
+        self.assertFalse(coffee_machine.stale)
+        self.assertFalse(coffee_machine.save_snapshot())  # unchanged since the brew started
+
+        restarted = DelongiPrimadonna(self.mac_address, snapshot_path=self.path)
+        self.assertTrue(restarted.stale)
+        self.assertEqual(restarted.hostname, 'D1234')
+        self.assertEqual(restarted.status, 'COOKING')
+        self.assertEqual(restarted.cooking, AvailableBeverage.ESPRESSO)
+        self.assertTrue(restarted.switches.is_on)
+        self.assertEqual(restarted.in_flight['beverage'], 'espresso')
+
+    def test_ignores_other_device(self):
+        """Test a snapshot for another MAC address is not loaded"""
+        DelongiPrimadonna('AA:BB:CC:DD:EE:FF', snapshot_path=self.path).save_snapshot()
+        coffee_machine = DelongiPrimadonna(self.mac_address, snapshot_path=self.path)
+        self.assertEqual(coffee_machine.status, 'UNKNOWN')
+
+    def test_reconcile_detects_unfinished_brew(self):
+        """Test reconcile reports a brew the machine is no longer running"""
+        coffee_machine = DelongiPrimadonna(self.mac_address, snapshot_path=self.path)
+        coffee_machine.in_flight = {'command': 'beverage_start', 'beverage': 'espresso'}
+        coffee_machine.cooking = AvailableBeverage.ESPRESSO
+
+        async def probe_status(machine, deadline):
+            await machine._handle_data(None, bytearray([0, 0, 0, 0, 1, 5, 0, 0, 0, 1]))
+            return True
+
+        with patch('src.delonghi_controller.probe_status', probe_status):
+            unfinished = asyncio.run(coffee_machine.reconcile())
+
+        self.assertEqual(unfinished['beverage'], 'espresso')
+        self.assertIsNone(coffee_machine.in_flight)
+        self.assertEqual(coffee_machine.cooking, AvailableBeverage.NONE)
+        self.assertIsNone(DelongiPrimadonna(self.mac_address, snapshot_path=self.path).in_flight)
+
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""Unit tests for the local order intake"""
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from src.delonghi_controller import (
+    DEBUG, DEVICE_READY, DelongiPrimadonna, MachineHost, beverage_order,
+)
+from src.order_intake import OrderIntake, parse_address
+from src.order_journal import (
+    CANCELLED, DONE, INTERRUPTED, STARTED, UNCONFIRMED, OrderJournal,
+)
+
+COOKING = bytearray([0, 0, 0, 0, 1, 3, 0, 0, 0, 1])
+READY = bytearray(DEVICE_READY)
+
+
+def patch_send_command(test):
+    """Make every machine's commands get through for the duration of a test"""
+    patcher = patch.object(DelongiPrimadonna, 'send_command', AsyncMock(return_value=True))
+    test.addCleanup(patcher.stop)
+    return patcher.start()
+
+
+async def wait_for_events(events, count):
+    """Let the loop run until count events arrived"""
+    async with asyncio.timeout(1):
+        while len(events) < count:
+            await asyncio.sleep(0)
+
+
+class TestOrderIntake(unittest.TestCase):
+    """Test cases for OrderIntake"""
+
+    def setUp(self):
+        """Set up a host with two machines whose commands always get through"""
+        self.host = MachineHost()
+        for mac in ('AA', 'BB'):
+            self.host.add(mac)
+        self.send_command = patch_send_command(self)
+
+    def intake(self, **kwargs):
+        """Make an intake for the test host"""
+        return OrderIntake(self.host, beverage_order, default_mac='AA', **kwargs)
+
+    def test_order_lifecycle(self):
+        """Test an order is queued, brewed and reported done when the machine finishes"""
+        async def run():
+            intake = self.intake()
+            events = []
+            intake.submit({'order_id': '0x1', 'beverage': 'espresso'}, events.append)
+            await wait_for_events(events, 2)
+            machine = self.host.machines['AA']
+            machine._on_notification(None, COOKING)
+            machine._on_notification(None, READY)
+            await wait_for_events(events, 3)
+            await intake.close()
+            return events
+
+        events = asyncio.run(run())
+        self.assertEqual([event['event'] for event in events], ['queued', 'brewing', 'done'])
+        self.assertEqual(events[0]['mac'], 'AA')
+        self.assertTrue(events[2]['confirmed'])
+
+    def test_rejected_orders(self):
+        """Test invalid orders fail right away without reaching a machine"""
+        async def run():
+            intake = self.intake()
+            events = []
+            intake.submit({'beverage': 'espresso'}, events.append)
+            intake.submit({'order_id': '1', 'beverage': 'power'}, events.append)
+            intake.submit({'order_id': '2', 'beverage': 'espresso', 'mac': 'CC'}, events.append)
+            intake.submit({'order_id': '3', 'beverage': 'espresso',
+                           'parameters': {'colour': 1}}, events.append)
+            await intake.close()
+            return events
+
+        events = asyncio.run(run())
+        self.assertEqual([event['event'] for event in events], ['failed'] * 4)
+        self.assertEqual([event.get('state') for event in events], [None] + ['rejected'] * 3)
+        self.assertIn('unknown machine', events[2]['error'])
+        self.send_command.assert_not_called()
+
+    def test_one_order_at_a_time(self):
+        """Test a machine's next order waits until the previous one finished"""
+        async def run():
+            intake = self.intake()
+            events = []
+            intake.submit({'order_id': '1', 'beverage': 'espresso'}, events.append)
+            intake.submit({'order_id': '2', 'beverage': 'coffee'}, events.append)
+            intake.submit({'order_id': '3', 'beverage': 'coffee', 'mac': 'BB'}, events.append)
+            await wait_for_events(events, 5)
+            brewing = [event['order_id'] for event in events if event['event'] == 'brewing']
+            machine = self.host.machines['AA']
+            machine._on_notification(None, COOKING)
+            machine._on_notification(None, READY)
+            await wait_for_events(events, 7)
+            await intake.close()
+            return brewing, events
+
+        brewing, events = asyncio.run(run())
+        self.assertEqual(brewing, ['1', '3'])
+        self.assertEqual(
+            [(event['order_id'], event['event']) for event in events[5:]],
+            [('1', 'done'), ('2', 'brewing')]
+        )
+
+    def test_retried_push(self):
+        """Test pushing a known order again follows it instead of brewing twice"""
+        async def run():
+            intake = self.intake()
+            first, second = [], []
+            intake.submit({'order_id': '1', 'beverage': 'espresso'}, first.append)
+            intake.submit({'order_id': '1', 'beverage': 'espresso'}, second.append)
+            await wait_for_events(first, 2)
+            machine = self.host.machines['AA']
+            machine._on_notification(None, COOKING)
+            machine._on_notification(None, READY)
+            await wait_for_events(first, 3)
+            await intake.close()
+            return second
+
+        second = asyncio.run(run())
+        self.assertEqual([event['event'] for event in second], ['queued', 'brewing', 'done'])
+        self.assertEqual(self.send_command.await_count, 1)
+
+    def test_missed_end_of_brew(self):
+        """Test a brew whose end was missed is confirmed by asking the machine"""
+        machine = self.host.machines['AA']
+
+        async def answer(message):
+            if message == DEBUG:
+                machine._on_notification(None, READY)
+            return True
+
+        async def run():
+            intake = self.intake(brew_timeout=0.01, status_timeout=0.5)
+            events = []
+            intake.submit({'order_id': '1', 'beverage': 'espresso'}, events.append)
+            await wait_for_events(events, 2)
+            machine._on_notification(None, COOKING)
+            self.send_command.side_effect = answer
+            await wait_for_events(events, 3)
+            await intake.close()
+            return events
+
+        events = asyncio.run(run())
+        self.assertEqual(events[2]['event'], 'done')
+        self.assertTrue(events[2]['confirmed'])
+
+    def test_unconfirmed_brew(self):
+        """Test an unconfirmed brew fails and holds the next order until the machine is idle"""
+        machine = self.host.machines['AA']
+
+        async def answer(message):
+            if message == DEBUG:
+                machine._on_notification(None, READY)
+            return True
+
+        async def run():
+            intake = self.intake(brew_timeout=0.01, status_timeout=0.01)
+            events = []
+            intake.submit({'order_id': '1', 'beverage': 'espresso'}, events.append)
+            intake.submit({'order_id': '2', 'beverage': 'coffee'}, events.append)
+            await wait_for_events(events, 4)
+            await asyncio.sleep(0.1)
+            held = [event['event'] for event in events if event['order_id'] == '2']
+            self.send_command.side_effect = answer
+            await wait_for_events(events, 5)
+            await intake.close()
+            return events, held
+
+        events, held = asyncio.run(run())
+        self.assertEqual(events[3]['event'], 'failed')
+        self.assertEqual(events[3]['state'], UNCONFIRMED)
+        self.assertEqual(held, ['queued'])
+        self.assertEqual((events[4]['order_id'], events[4]['event']), ('2', 'brewing'))
+
+    def test_start_command_not_sent(self):
+        """Test an order fails when its start command cannot be written"""
+        self.send_command.return_value = False
+
+        async def run():
+            intake = self.intake()
+            events = []
+            intake.submit({'order_id': '1', 'beverage': 'espresso'}, events.append)
+            await wait_for_events(events, 2)
+            await intake.close()
+            return events
+
+        events = asyncio.run(run())
+        self.assertEqual([event['event'] for event in events], ['queued', 'failed'])
+        self.assertEqual(events[1]['state'], 'failed')
+
+    def test_tcp(self):
+        """Test orders pushed over TCP are acknowledged on the same connection"""
+        async def run():
+            intake = self.intake()
+            host, port = await intake.start('127.0.0.1:0')
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(b'not json\n{"order_id": "1", "beverage": "espresso"}\n')
+            lines = [json.loads(await reader.readline()) for _ in range(3)]
+            writer.close()
+            await intake.close()
+            return lines
+
+        lines = asyncio.run(run())
+        self.assertEqual([line['event'] for line in lines], ['failed', 'queued', 'brewing'])
+
+    def test_parse_address(self):
+        """Test listen addresses are split into host and port"""
+        self.assertEqual(parse_address('0.0.0.0:9000'), ('0.0.0.0', 9000))
+        self.assertEqual(parse_address(':9000'), ('127.0.0.1', 9000))
+        with self.assertRaises(ValueError):
+            parse_address('localhost')
+
+
+class TestOrderIntakeJournal(unittest.TestCase):
+    """Test cases for orders pushed again after a restart"""
+
+    def setUp(self):
+        """Set up a host whose journal remembers orders of an earlier run"""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.journal = OrderJournal(os.path.join(self.temp_dir.name, 'journal.sqlite3'))
+        for order_id, state in (('1', STARTED), ('2', STARTED), ('3', CANCELLED), ('4', DONE)):
+            self.journal.begin(order_id, 'AA', 'espresso')
+            self.journal.record(order_id, state)
+        self.host = MachineHost(journal=self.journal)
+        self.machine = self.host.add('AA')
+        self.send_command = patch_send_command(self)
+
+    def tearDown(self):
+        """Close the journal and remove the temporary directory"""
+        self.journal.close()
+        self.temp_dir.cleanup()
+
+    def push(self, order_id, count, machine_events=()):
+        """Push an order and return its events once count arrived"""
+        async def run():
+            intake = OrderIntake(self.host, beverage_order, default_mac='AA')
+            events = []
+            intake.submit({'order_id': order_id, 'beverage': 'espresso'}, events.append)
+            await wait_for_events(events, 2)
+            for frame in machine_events:
+                self.machine._on_notification(None, frame)
+            await wait_for_events(events, count)
+            await intake.close()
+            return events
+
+        return asyncio.run(run())
+
+    def test_still_brewing(self):
+        """Test an order the machine still brews is followed until done"""
+        self.machine.in_flight = {'command': 'beverage_start', 'beverage': 'espresso',
+                                  'order_id': '1', 'started_at': 0.0}
+        events = self.push('1', 3, (COOKING, READY))
+        self.assertEqual([event['event'] for event in events], ['queued', 'brewing', 'done'])
+        self.assertEqual(events[1]['state'], STARTED)
+        self.send_command.assert_not_called()
+
+    def test_interrupted_while_followed(self):
+        """Test an order reconcile settles as interrupted is not reported done"""
+        self.machine.in_flight = {'command': 'beverage_start', 'beverage': 'espresso',
+                                  'order_id': '1', 'started_at': 0.0}
+
+        async def run():
+            intake = OrderIntake(self.host, beverage_order, default_mac='AA')
+            events = []
+            intake.submit({'order_id': '1', 'beverage': 'espresso'}, events.append)
+            await wait_for_events(events, 2)
+            self.machine._record_order(INTERRUPTED)
+            self.machine.in_flight = None
+            self.machine._wake_finish_waiters()
+            await wait_for_events(events, 3)
+            await intake.close()
+            return events
+
+        events = asyncio.run(run())
+        self.assertEqual(events[2]['event'], 'failed')
+        self.assertEqual(events[2]['state'], INTERRUPTED)
+
+    def test_unconfirmed_journaled(self):
+        """Test an unconfirmed order is journaled as such and never brewed again"""
+        self.send_command.return_value = False
+        self.machine.in_flight = {'command': 'beverage_start', 'beverage': 'espresso',
+                                  'order_id': '1', 'started_at': 0.0}
+
+        async def run():
+            intake = OrderIntake(self.host, beverage_order, default_mac='AA',
+                                 brew_timeout=0.01, status_timeout=0.01)
+            events = []
+            intake.submit({'order_id': '1', 'beverage': 'espresso'}, events.append)
+            await wait_for_events(events, 3)
+            await intake.close()
+            return events
+
+        self.assertEqual(asyncio.run(run())[2]['state'], UNCONFIRMED)
+        self.assertEqual(self.journal.state('1'), UNCONFIRMED)
+        self.assertIsNone(self.machine.in_flight)
+        self.assertNotIn('1', [order['order_id'] for order in self.journal.in_flight('AA')])
+        self.assertEqual(self.push('1', 2)[1]['state'], UNCONFIRMED)
+
+    def test_unreachable_machine(self):
+        """Test an order fails with its journal state when the machine is unreachable"""
+        self.send_command.side_effect = OSError('device not found')
+        events = self.push('5', 2)
+        self.assertEqual(events[1]['event'], 'failed')
+        self.assertEqual(events[1]['state'], 'failed')
+        self.assertIn('device not found', events[1]['error'])
+
+    def test_earlier_states(self):
+        """Test other orders of an earlier run report their journaled state"""
+        unknown = self.push('2', 2)
+        self.assertEqual(unknown[1]['event'], 'failed')
+        self.assertEqual(unknown[1]['state'], STARTED)
+        self.assertIn('outcome is unknown', unknown[1]['error'])
+        cancelled = self.push('3', 2)
+        self.assertEqual(cancelled[1]['state'], CANCELLED)
+        done = self.push('4', 2)
+        self.assertEqual(done[1]['event'], 'done')
+        self.send_command.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""Unit tests for the order dispatch journal"""
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from src.delonghi_controller import DelongiPrimadonna, AvailableBeverage
+from src.order_journal import OrderJournal, DISPATCHED, STARTED, DONE, FAILED, INTERRUPTED
+
+
+class TestOrderJournal(unittest.TestCase):
+    """Test cases for OrderJournal"""
+
+    def setUp(self):
+        """Set up a journal in a temporary directory"""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, 'journal.sqlite3')
+        self.journal = OrderJournal(self.path)
+        self.mac_address = "00:11:22:33:44:55"
+
+    def tearDown(self):
+        """Close the journal and remove the temporary directory"""
+        self.journal.close()
+        self.temp_dir.cleanup()
+
+    def test_duplicate_dropped(self):
+        """Test an order is dispatched only once"""
+        self.assertTrue(self.journal.begin('order-1', self.mac_address, 'espresso'))
+        self.assertFalse(self.journal.begin('order-1', self.mac_address, 'espresso'))
+        self.assertEqual(self.journal.state('order-1'), DISPATCHED)
+
+    def test_retry_after_failure(self):
+        """Test a failed order can be dispatched again"""
+        self.journal.begin('order-1', self.mac_address, 'espresso')
+        self.journal.record('order-1', FAILED)
+        self.assertTrue(self.journal.begin('order-1', self.mac_address, 'espresso'))
+
+    def test_retry_after_interruption(self):
+        """Test an interrupted order is listed and can be dispatched again"""
+        self.journal.begin('order-1', self.mac_address, 'espresso')
+        self.journal.record('order-1', INTERRUPTED)
+        self.assertEqual([order['order_id'] for order in self.journal.interrupted()], ['order-1'])
+        self.assertEqual(self.journal.in_flight(), [])
+        self.assertTrue(self.journal.begin('order-1', self.mac_address, 'espresso'))
+        self.assertEqual(self.journal.interrupted(), [])
+
+    def test_in_flight_survives_restart(self):
+        """Test unfinished orders are listed after reopening the journal"""
+        self.journal.begin('order-1', self.mac_address, 'espresso')
+        self.journal.record('order-1', STARTED)
+        self.journal.begin('order-2', self.mac_address, 'coffee')
+        self.journal.record('order-2', DONE)
+        self.journal.begin('order-3', 'AA:BB:CC:DD:EE:FF', 'long')
+        self.journal.close()
+
+        self.journal = OrderJournal(self.path)
+        in_flight = self.journal.in_flight(self.mac_address)
+        self.assertEqual([order['order_id'] for order in in_flight], ['order-1'])
+        self.assertEqual(in_flight[0]['state'], STARTED)
+        self.assertEqual(len(self.journal.in_flight()), 2)
+
+    @patch.object(DelongiPrimadonna, 'send_command', new_callable=AsyncMock, return_value=True)
+    def test_dispatch_is_idempotent(self, send_command):
+        """Test the controller brews a retried order only once"""
+        coffee_machine = DelongiPrimadonna(self.mac_address, journal=self.journal)
+
+        async def dispatch_twice():
+            first = await coffee_machine.dispatch(AvailableBeverage.ESPRESSO, 'order-1')
+            second = await coffee_machine.dispatch(AvailableBeverage.ESPRESSO, 'order-1')
+            return first, second
+
+        self.assertEqual(asyncio.run(dispatch_twice()), (STARTED, STARTED))
+        send_command.assert_called_once()
+        self.assertEqual(coffee_machine.in_flight['order_id'], 'order-1')
+
+        # The machine reports brewing, then idle
+        asyncio.run(coffee_machine._handle_data(None, bytearray([0, 0, 0, 0, 1, 3, 0, 0, 0, 1])))
+        asyncio.run(coffee_machine._handle_data(None, bytearray([0, 0, 0, 0, 1, 5, 0, 0, 0, 1])))
+        self.assertEqual(self.journal.state('order-1'), DONE)
+        self.assertIsNone(coffee_machine.in_flight)
+
+    @patch.object(DelongiPrimadonna, '_connect', new_callable=AsyncMock,
+                  side_effect=[Exception('device not found'), None])
+    def test_retry_after_connect_error(self, _connect):
+        """Test an order whose dispatch raised can be brewed on a retry"""
+        coffee_machine = DelongiPrimadonna(self.mac_address, journal=self.journal)
+        coffee_machine._client = MagicMock()
+        coffee_machine._client.write_gatt_char = AsyncMock()
+
+        with self.assertRaises(Exception):
+            asyncio.run(coffee_machine.dispatch(AvailableBeverage.ESPRESSO, 'order-1'))
+        self.assertEqual(self.journal.state('order-1'), FAILED)
+        self.assertIsNone(coffee_machine.in_flight)
+
+        state = asyncio.run(coffee_machine.dispatch(AvailableBeverage.ESPRESSO, 'order-1'))
+        self.assertEqual(state, STARTED)
+        coffee_machine._client.write_gatt_char.assert_awaited_once()
+
+    def test_reconcile_interrupts_orders(self):
+        """Test reconcile journals orders the machine no longer brews as interrupted"""
+        self.journal.begin('order-0', self.mac_address, 'coffee')  # missed by the snapshot
+        self.journal.begin('order-1', self.mac_address, 'espresso')
+        self.journal.record('order-1', STARTED)
+        coffee_machine = DelongiPrimadonna(self.mac_address, journal=self.journal)
+        coffee_machine.in_flight = {'command': 'beverage_start', 'beverage': 'espresso',
+                                    'order_id': 'order-1'}
+
+        async def probe_status(machine, deadline):
+            await machine._handle_data(None, bytearray([0, 0, 0, 0, 1, 5, 0, 0, 0, 1]))
+            return True
+
+        with patch('src.delonghi_controller.probe_status', probe_status):
+            unfinished = asyncio.run(coffee_machine.reconcile())
+
+        self.assertEqual(unfinished['order_id'], 'order-1')
+        self.assertEqual(self.journal.state('order-0'), INTERRUPTED)
+        self.assertEqual(self.journal.state('order-1'), INTERRUPTED)
+        self.assertEqual(self.journal.in_flight(), [])
+
+    def test_reconcile_keeps_running_brew(self):
+        """Test reconcile leaves alone the order the machine is still brewing"""
+        self.journal.begin('order-1', self.mac_address, 'espresso')
+        self.journal.record('order-1', STARTED)
+        coffee_machine = DelongiPrimadonna(self.mac_address, journal=self.journal)
+        coffee_machine.in_flight = {'command': 'beverage_start', 'beverage': 'espresso',
+                                    'order_id': 'order-1'}
+
+        async def probe_status(machine, deadline):
+            await machine._handle_data(None, bytearray([0, 0, 0, 0, 1, 3, 0, 0, 0, 1]))
+            return True
+
+        with patch('src.delonghi_controller.probe_status', probe_status):
+            self.assertIsNone(asyncio.run(coffee_machine.reconcile()))
+        self.assertEqual(self.journal.state('order-1'), STARTED)
+
+    def test_reconcile_after_restart_while_cooking(self):
+        """Test a brew restored from a COOKING snapshot is interrupted, not done"""
+        snapshot_path = os.path.join(self.temp_dir.name, 'machine.json')
+        self.journal.begin('order-1', self.mac_address, 'espresso')
+        self.journal.record('order-1', STARTED)
+        coffee_machine = DelongiPrimadonna(self.mac_address, snapshot_path=snapshot_path,
+                                           journal=self.journal)
+        coffee_machine.in_flight = {'command': 'beverage_start', 'beverage': 'espresso',
+                                    'order_id': 'order-1'}
+        coffee_machine._on_notification(None, bytearray([0, 0, 0, 0, 1, 3, 0, 0, 0, 1]))
+        coffee_machine.save_snapshot()
+
+        restarted = DelongiPrimadonna(self.mac_address, snapshot_path=snapshot_path,
+                                      journal=self.journal)
+
+        async def probe_status(machine, deadline):
+            await machine._handle_data(None, bytearray([0, 0, 0, 0, 1, 5, 0, 0, 0, 1]))
+            return True
+
+        with patch('src.delonghi_controller.probe_status', probe_status):
+            unfinished = asyncio.run(restarted.reconcile())
+
+        self.assertEqual(unfinished['order_id'], 'order-1')
+        self.assertEqual(self.journal.state('order-1'), INTERRUPTED)
+
+    @patch.object(DelongiPrimadonna, 'send_command', new_callable=AsyncMock, return_value=False)
+    def test_failed_dispatch(self, send_command):
+        """Test a start command which could not be sent is journaled as failed"""
+        coffee_machine = DelongiPrimadonna(self.mac_address, journal=self.journal)
+        state = asyncio.run(coffee_machine.dispatch(AvailableBeverage.ESPRESSO, 'order-1'))
+        self.assertEqual(state, FAILED)
+        self.assertIsNone(coffee_machine.in_flight)
+        self.assertEqual(self.journal.in_flight(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
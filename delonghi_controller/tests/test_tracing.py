@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Unit tests for per-order tracing"""
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from src.delonghi_controller import DelongiPrimadonna, AvailableBeverage, MachineHost
+from src.tracing import DISABLED, Tracer, current_order
+
+
+class TestTracer(unittest.TestCase):
+    """Test cases for Tracer"""
+
+    def test_span_and_instant(self):
+        """Test spans and instants become trace events on named lanes"""
+        tracer = Tracer()
+        with tracer.span('connect', 'AA', adapter='hci0'):
+            tracer.instant('notification', 'AA')
+        metadata, instant, span = tracer.events()
+        self.assertEqual(metadata['ph'], 'M')
+        self.assertEqual(metadata['args'], {'name': 'AA'})
+        self.assertEqual(instant['ph'], 'i')
+        self.assertEqual(span['ph'], 'X')
+        self.assertEqual(span['args'], {'adapter': 'hci0'})
+        self.assertGreaterEqual(span['dur'], 0)
+        self.assertEqual(span['tid'], instant['tid'])
+
+    def test_span_error(self):
+        """Test a failing span is recorded with its error"""
+        tracer = Tracer()
+        with self.assertRaises(OSError):
+            with tracer.span('connect'):
+                raise OSError('gone')
+        self.assertIn('OSError', tracer.events()[-1]['args']['error'])
+
+    def test_current_order(self):
+        """Test events carry the current order unless given one"""
+        tracer = Tracer()
+        token = current_order.set('order-1')
+        try:
+            tracer.instant('a')
+            tracer.instant('b', order_id='order-2')
+        finally:
+            current_order.reset(token)
+        tracer.instant('c')
+        self.assertEqual(
+            [event['args'].get('order_id') for event in tracer.events()[1:]],
+            ['order-1', 'order-2', None]
+        )
+
+    def test_disabled(self):
+        """Test a disabled tracer records nothing"""
+        with DISABLED.span('connect'):
+            DISABLED.instant('notification')
+        self.assertEqual(DISABLED.events(), [])
+
+    def test_export(self):
+        """Test the trace is written as Chrome trace-event JSON"""
+        tracer = Tracer()
+        with tracer.span('connect'):
+            pass
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'trace.json')
+            tracer.export(path)
+            with open(path, encoding='utf-8') as trace_file:
+                trace = json.load(trace_file)
+        self.assertEqual(len(trace['traceEvents']), 2)
+
+    def test_bounded(self):
+        """Test only the latest events are kept, with the lane names"""
+        tracer = Tracer(max_events=3)
+        for index in range(5):
+            tracer.instant(str(index), 'AA')
+        self.assertEqual([event['name'] for event in tracer.events()],
+                         ['thread_name', '2', '3', '4'])
+
+    def test_changed(self):
+        """Test a tracer reports events recorded since its last export"""
+        tracer = Tracer()
+        self.assertFalse(tracer.changed)
+        tracer.instant('notification')
+        self.assertTrue(tracer.changed)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            tracer.export(os.path.join(temp_dir, 'trace.json'))
+        self.assertFalse(tracer.changed)
+
+    def test_host_exports_periodically(self):
+        """Test a serving host keeps the trace file up to date"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'trace.json')
+
+            async def run():
+                host = MachineHost(tracer=Tracer(), trace_path=path)
+                host.start(interval=0.01)
+                host.tracer.instant('notification')
+                await asyncio.sleep(0.05)
+                exported = os.path.exists(path)
+                host.tracer.instant('notification')
+                await host.close()
+                return exported
+
+            self.assertTrue(asyncio.run(run()))
+            with open(path, encoding='utf-8') as trace_file:
+                self.assertEqual(len(json.load(trace_file)['traceEvents']), 3)
+
+
+class TestControllerTracing(unittest.TestCase):
+    """Test cases for the spans recorded by the controller"""
+
+    def setUp(self):
+        """Set up BLE mocks"""
+        self.mock_client_patcher = patch('src.delonghi_controller.BleakClient')
+        self.mock_client = self.mock_client_patcher.start()
+        self.mock_scanner_patcher = patch('src.delonghi_controller.BleakScanner')
+        self.mock_scanner = self.mock_scanner_patcher.start()
+        self.mock_scanner.find_device_by_address = AsyncMock(return_value=MagicMock())
+
+        self.mock_client_instance = MagicMock()
+        self.mock_client_instance.is_connected = False
+        self.mock_client_instance.connect = AsyncMock()
+        self.mock_client_instance.start_notify = AsyncMock()
+        self.mock_client_instance.write_gatt_char = AsyncMock()
+        self.mock_client.return_value = self.mock_client_instance
+
+    def tearDown(self):
+        """Tear down BLE mocks"""
+        self.mock_client_patcher.stop()
+        self.mock_scanner_patcher.stop()
+
+    def test_dispatch_timeline(self):
+        """Test one order's timeline covers connect, write and notifications"""
+        tracer = Tracer()
+        coffee_machine = DelongiPrimadonna('AA', tracer=tracer)
+        asyncio.run(coffee_machine.dispatch(AvailableBeverage.ESPRESSO, 'order-1'))
+        asyncio.run(coffee_machine._handle_data(None, bytearray([0, 0, 0, 0, 1, 3, 0, 0, 0, 1])))
+
+        events = [event for event in tracer.events() if event['ph'] != 'M']
+        self.assertEqual(
+            [event['name'] for event in events],
+            ['find_device_by_address', 'client.connect', 'start_notify', 'connect',
+             'send_command', 'dispatch', 'notification', 'status COOKING']
+        )
+        self.assertTrue(all(event['args']['order_id'] == 'order-1' for event in events))
+
+
+if __name__ == '__main__':
+    unittest.main()